@@ -19,6 +19,24 @@ sys.modules['comfy.sd'] = mock_comfy.sd
 sys.modules['folder_paths'] = mock_folder_paths
 
 
+@pytest.fixture(autouse=True)
+def isolated_generation_index(tmp_path_factory, monkeypatch):
+    """Keep the local SQLite index out of the repo while testing"""
+    import hydrus_node
+    index = hydrus_node.GenerationIndex(str(tmp_path_factory.mktemp("index") / "hydrus_index.sqlite3"))
+    monkeypatch.setattr(hydrus_node, "generation_index", index)
+    return index
+
+
+@pytest.fixture(autouse=True)
+def isolated_file_cache(tmp_path_factory, monkeypatch):
+    """Keep downloaded files out of the repo while testing"""
+    import hydrus_node
+    cache = hydrus_node.FileCache(str(tmp_path_factory.mktemp("file_cache")), 1024 ** 2)
+    monkeypatch.setattr(hydrus_node, "file_cache", cache)
+    return cache
+
+
 @pytest.fixture
 def mock_hydrus_client():
     """Mock Hydrus API client for testing"""
@@ -26,7 +44,7 @@ def mock_hydrus_client():
     client.get_services.return_value = {
         'local_tags': [{'name': 'my tags', 'service_key': 'test_service_key'}]
     }
-    client.search_files.return_value = {'file_ids': [1, 2, 3]}
+    client.search_files.return_value = {'file_ids': [1, 2, 3], 'hashes': ['test_hash_123']}
     client.get_file_metadata.return_value = {
         'metadata': [
             {
@@ -3,22 +3,86 @@ from datetime import datetime
 import json
 import time
 import hashlib
+import re
+import io
+import atexit
+import queue
+import threading
+import functools
+import sqlite3
+import mmap
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import comfy
 from comfy import sd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hydrus_api
 import hydrus_api.utils
 from hydrus_api import ImportStatus
 import folder_paths
 import numpy as np
-from tempfile import TemporaryFile
 from PIL.PngImagePlugin import PngInfo
 from PIL import Image
+try:
+    from .hydrus_tags import normalize_tag
+except ImportError:
+    # Imported on its own (tests) rather than as ComfyUI's custom node package
+    from hydrus_tags import normalize_tag
 
 REQUIRED_PERMISSIONS = (hydrus_api.Permission.IMPORT_FILES, hydrus_api.Permission.ADD_TAGS)
 hydrus_key = os.environ.get("HYDRUS_KEY")
 hydrus_url = os.environ.get("HYDRUS_URL")
 hydrus_logging_prefix = "\033[0;34m[\033[0;39mHydrus\033[0;34m]\033[0;39m"
+# How many images can be waiting on Hydrus before async imports start blocking the graph again
+upload_queue_size = int(os.environ.get("HYDRUS_UPLOAD_QUEUE_SIZE", 32))
+# How long ComfyUI waits at exit for queued uploads, in seconds. Whatever hasn't started by then goes to the spool
+upload_flush_timeout = float(os.environ.get("HYDRUS_UPLOAD_FLUSH_TIMEOUT", 60))
+# Threads used to encode a batch, PIL lets go of the GIL while compressing so threads are enough
+encode_workers = int(os.environ.get("HYDRUS_ENCODE_WORKERS", os.cpu_count() or 1))
+# Where spooled imports wait for Hydrus, and how many batches get replayed at once
+spool_dir = os.environ.get("HYDRUS_SPOOL_DIR", os.path.join(os.path.dirname(os.path.realpath(__file__)), "spool"))
+spool_workers = int(os.environ.get("HYDRUS_SPOOL_WORKERS", 2))
+# A directory both ComfyUI and Hydrus can see, for local_path_import. If Hydrus mounts it somewhere else, set
+# HYDRUS_SHARED_DIR_REMOTE to the path Hydrus uses
+shared_dir = os.environ.get("HYDRUS_SHARED_DIR")
+shared_dir_remote = os.environ.get("HYDRUS_SHARED_DIR_REMOTE", shared_dir)
+# How long dedupe waits for both files of a pair to show up in Hydrus, in seconds
+dedupe_timeout = float(os.environ.get("HYDRUS_DEDUPE_TIMEOUT", 30))
+# How much (roughly, going by file size) loaded checkpoints the exporter keeps around, in GB
+checkpoint_cache_gb = float(os.environ.get("HYDRUS_CHECKPOINT_CACHE_GB", 12))
+# Local SQLite index of generation metadata, and how often use_index catches up with Hydrus, in seconds
+index_path = os.environ.get("HYDRUS_INDEX_PATH", os.path.join(os.path.dirname(os.path.realpath(__file__)), "hydrus_index.sqlite3"))
+index_sync_interval = float(os.environ.get("HYDRUS_INDEX_SYNC_INTERVAL", 300))
+# Local copies of files downloaded from Hydrus, keyed by sha256. Set the size to 0 to turn it off
+file_cache_dir = os.environ.get("HYDRUS_FILE_CACHE_DIR", os.path.join(os.path.dirname(os.path.realpath(__file__)), "file_cache"))
+file_cache_gb = float(os.environ.get("HYDRUS_FILE_CACHE_GB", 10))
+# How many files the exporter downloads ahead of the one it's working on
+prefetch_depth = int(os.environ.get("HYDRUS_PREFETCH_DEPTH", 4))
+# Set to 1 to decode exports into pinned memory so the copy to the GPU is quicker. Only does anything with CUDA.
+# Off by default: ComfyUI keeps outputs around, and a big export can use up the page-locked memory there is
+pin_memory = os.environ.get("HYDRUS_PIN_MEMORY", "0") == "1"
+# How long permissions and service keys are trusted before asking Hydrus again, in seconds
+hydrus_cache_ttl = float(os.environ.get("HYDRUS_CACHE_TTL", 300))
+# Connection settings for talking to Hydrus, timeouts are in seconds
+hydrus_connect_timeout = float(os.environ.get("HYDRUS_CONNECT_TIMEOUT", 5))
+hydrus_read_timeout = float(os.environ.get("HYDRUS_READ_TIMEOUT", 120))
+hydrus_retries = int(os.environ.get("HYDRUS_RETRIES", 3))
+hydrus_retry_backoff = float(os.environ.get("HYDRUS_RETRY_BACKOFF", 0.5))
+hydrus_pool_size = int(os.environ.get("HYDRUS_POOL_SIZE", 8))
+# 503 is what Hydrus sends while the database is locked, the rest are the usual proxy/restart hiccups
+RETRY_STATUSES = (500, 502, 503, 504)
+# first: only the first file with the tag, next: one file per run working through the tag,
+# batch: every file for one model per run, stacked into a single IMAGE batch
+TAG_MODES = ["first", "next", "batch"]
+# Hydrus takes the hashes in the URL, so big metadata lookups get split into requests of this many
+METADATA_CHUNK_SIZE = 100
+# What an export reads from a file's generation tags. Index rows missing any of these get asked for again
+EXPORT_FIELDS = ('modelname', 'positive', 'negative', 'seed')
+COMPRESSION_LEVELS = ["optimize", "auto"] + [str(level) for level in range(10)]
+FILE_FORMATS = ["PNG", "WEBP"]
 
 # image I/O
 def get_timestamp(time_format="%Y-%m-%d-%H%M%S"):
@@ -30,8 +94,125 @@ def get_timestamp(time_format="%Y-%m-%d-%H%M%S"):
 
     return(timestamp)
 
+def images_to_uint8(images):
+    # Scale, clamp and cast the whole batch on whatever device it already lives on, then copy it to the host once.
+    # uint8 is a quarter of the size of float32, so that copy is too
+    return images.mul(255.).clamp_(0, 255).to(torch.uint8).cpu().numpy()
+
+class HydrusServiceCache:
+    # Permissions and services almost never change, so remember them per Hydrus instance and API key instead of
+    # asking on every image. Shared by every node in the process.
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def client_key(self, client):
+        return (client.api_url, client.access_key)
+
+    def get(self, client, name, loader):
+        key = self.client_key(client) + (name,)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+        value = loader(client)
+        # Failed lookups aren't kept, so fixing the key or services in Hydrus works straight away
+        if value:
+            with self.lock:
+                self.entries[key] = (time.monotonic(), value)
+        return value
+
+    def invalidate(self, client=None):
+        with self.lock:
+            if client is None:
+                self.entries.clear()
+                return
+            client_key = self.client_key(client)
+            for key in [key for key in self.entries if key[:2] == client_key]:
+                del self.entries[key]
+
+service_cache = HydrusServiceCache(hydrus_cache_ttl)
+
+def invalidate_hydrus_cache(client=None):
+    service_cache.invalidate(client)
+
+def verify_hydrus_permissions(client):
+    return service_cache.get(client, "permissions", lambda c: hydrus_api.utils.verify_permissions(c, REQUIRED_PERMISSIONS))
+
+def get_hydrus_services(client):
+    return service_cache.get(client, "services", lambda c: c.get_services())
+
+def stack_images(images):
+    # Same as ComfyUI's own batching, anything that isn't the size of the first image gets resized to match
+    height, width = images[0].shape[1:3]
+    resized = []
+    for image in images:
+        if image.shape[1:3] != (height, width):
+            image = torch.nn.functional.interpolate(image.movedim(-1, 1), size=(height, width), mode="bilinear").movedim(1, -1)
+        resized.append(image)
+    return torch.cat(resized)
+
+def parse_generation_tags(tags):
+    # One pass over the tags, looking only at the namespace. Checking for "seed:" anywhere in the tag used to pick up
+    # prompts that happened to contain it
+    outputs = {}
+    outputs['loras'] = []
+    for i in tags:
+        namespace, colon, value = i.partition(':')
+        if not colon:
+            continue
+        if namespace == 'lora':
+            outputs['loras'].append(value.lstrip())
+        elif namespace in ('modelname', 'positive', 'negative', 'seed'):
+            outputs[namespace] = value.lstrip()
+    return outputs
+
+def hash_file(path, chunk_size=1024 * 1024):
+    # sha256 of a local file, read in chunks so big files don't end up in memory. Unchanged files (same size and
+    # mtime) get their hash from the index instead of being read again
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    try:
+        cached = generation_index.cached_hash(path, stat.st_size, stat.st_mtime_ns)
+    except sqlite3.Error:
+        cached = None
+    if cached is not None:
+        return cached
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha256.update(chunk)
+    hash = sha256.hexdigest()
+    try:
+        generation_index.remember_hash(path, stat.st_size, stat.st_mtime_ns, hash)
+    except sqlite3.Error as e:
+        print("{} Couldn't remember the hash of {}: {}".format(hydrus_logging_prefix, path, e))
+    return hash
+
+# input dir -> (directory mtime, sorted file names)
+input_listing_cache = {}
+
+def list_input_files(input_dir):
+    # ComfyUI asks for INPUT_TYPES on every refresh, and listing a huge input dir every time stalls the UI.
+    # Adding, removing or renaming a file changes the directory's mtime, so the sorted listing is kept until it does
+    try:
+        mtime = os.stat(input_dir).st_mtime_ns
+    except OSError:
+        return []
+    cached = input_listing_cache.get(input_dir)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with os.scandir(input_dir) as entries:
+        files = sorted(entry.name for entry in entries if entry.is_file())
+    # Filesystems with coarse timestamps can change twice within one tick, so a directory touched in the last couple
+    # of seconds gets listed again next time
+    if time.time_ns() - mtime > 2 * 10 ** 9:
+        input_listing_cache[input_dir] = (mtime, files)
+    return files
+
 def get_hydrus_service_key(client):
-    local_tags = client.get_services().get('local_tags')
+    local_tags = get_hydrus_services(client).get('local_tags')
     service_key = ""
     for i in local_tags:
         if i['name'] == 'my tags':
@@ -41,12 +222,43 @@ def get_hydrus_service_key(client):
             break
     return service_key
 
+class HydrusSessionPool:
+    # Goes in place of a requests.Session on hydrus_api.Client (it only ever calls session.request).
+    # Every thread gets its own Session, but they all share one keep-alive connection pool, so a client can be
+    # handed to the upload worker without two threads sharing Session state.
+    def __init__(self, connect_timeout=5, read_timeout=120, retries=3, backoff=0.5, pool_size=8):
+        self.timeout = (connect_timeout, read_timeout)
+        # Everything the nodes send is safe to repeat (re-adding a file or a tag is a no-op), so POSTs retry too
+        retry_options = dict(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES, allowed_methods=None, raise_on_status=False)
+        try:
+            retry = Retry(backoff_jitter=backoff, **retry_options)
+        except TypeError:
+            # urllib3 1.x has no jitter
+            retry = Retry(**retry_options)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.local = threading.local()
+
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            self.local.session = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session().request(method, url, **kwargs)
+
+session_pool = HydrusSessionPool(hydrus_connect_timeout, hydrus_read_timeout, hydrus_retries, hydrus_retry_backoff, hydrus_pool_size)
+
 def get_hydrus_client():
     # Create a Hydrus client based on env vars or files. This is extremely unlikely to change in any meaningful time
     global hydrus_key
     global hydrus_url
     if hydrus_key is not None and hydrus_url is not None:
-        return hydrus_api.Client(hydrus_key, hydrus_url)
+        return hydrus_api.Client(hydrus_key, hydrus_url, session=session_pool)
 
     # Check for API key in file as a backup, not recommended
     # Example, note this isn't a real API key:
@@ -71,7 +283,654 @@ def get_hydrus_client():
         print("Exception: {}".format(e))
         print("{} API Key is required to save the image outputs to Hydrus. \n{} Please set the HYDRUS_API_KEY environment variable to your API key, \n{} and HYDRUS_API_URL to your API URL or place in hydrus_api.txt.".format(hydrus_logging_prefix, hydrus_logging_prefix, hydrus_logging_prefix))
 
-    return hydrus_api.Client(hydrus_key, hydrus_url)
+    return hydrus_api.Client(hydrus_key, hydrus_url, session=session_pool)
+
+class CompressionTuner:
+    # Picks a compression level for "auto" by comparing how long each level takes to encode against how long
+    # the bytes it saves would have taken to upload. Every measurement is a moving average so it follows the network.
+    CANDIDATES = (1, 3, 6, 9)
+    DEFAULT_LEVEL = 6
+
+    def __init__(self, smoothing=0.3):
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        # (file_format, level) -> [encode seconds per raw byte, encoded bytes per raw byte]
+        self.encode_stats = {}
+        self.upload_rate = None
+
+    def average(self, old, new):
+        if old is None:
+            return new
+        return old + self.smoothing * (new - old)
+
+    def record_encode(self, file_format, level, raw_bytes, encoded_bytes, seconds):
+        if raw_bytes <= 0:
+            return
+        with self.lock:
+            old_speed, old_ratio = self.encode_stats.get((file_format, level), (None, None))
+            self.encode_stats[(file_format, level)] = [
+                self.average(old_speed, seconds / raw_bytes),
+                self.average(old_ratio, encoded_bytes / raw_bytes),
+            ]
+
+    def record_upload(self, nbytes, seconds):
+        if nbytes <= 0 or seconds <= 0:
+            return
+        with self.lock:
+            self.upload_rate = self.average(self.upload_rate, nbytes / seconds)
+
+    def choose(self, file_format="PNG"):
+        with self.lock:
+            if self.upload_rate is None:
+                return self.DEFAULT_LEVEL
+            # Try every candidate once before trusting the numbers
+            for level in self.CANDIDATES:
+                if (file_format, level) not in self.encode_stats:
+                    return level
+            def cost(level):
+                speed, ratio = self.encode_stats[(file_format, level)]
+                return speed + ratio / self.upload_rate
+            return min(self.CANDIDATES, key=cost)
+
+compression_tuner = CompressionTuner()
+encode_pool = ThreadPoolExecutor(max_workers=encode_workers, thread_name_prefix="hydrus-encode")
+
+class HashingBuffer(io.BytesIO):
+    # In-memory file that hashes the bytes as the encoder writes them, so nothing has to be read back afterwards
+    def __init__(self):
+        super().__init__()
+        self.sha256 = hashlib.sha256()
+        self.hashed = 0
+
+    def write(self, data):
+        if self.sha256 is not None and self.tell() == self.hashed:
+            self.sha256.update(data)
+            self.hashed += len(data)
+        else:
+            # Something seeked back and rewrote part of the file, hash it the slow way at the end instead
+            self.sha256 = None
+        return super().write(data)
+
+    def hexdigest(self):
+        if self.sha256 is None:
+            return hashlib.sha256(self.getbuffer()).hexdigest()
+        return self.sha256.hexdigest()
+
+    def reader(self):
+        return MemoryviewReader(self)
+
+class MemoryviewReader:
+    # hydrus_api hands whatever read() returns straight to requests, which sends a memoryview as it is.
+    # That way the upload goes out of the encode buffer without copying it
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def read(self):
+        return self.buffer.getbuffer()
+
+class HydrusUploadQueue:
+    # Bounded in-process queue with a single worker thread, so the graph can hand images off and keep generating.
+    # put() blocks once the queue is full, which is the backpressure if Hydrus can't keep up.
+    def __init__(self, maxsize=32):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name="hydrus-upload", daemon=True)
+                self.worker.start()
+
+    def put(self, job, timeout=None, spool=None):
+        # job is any callable, it gets run on the worker thread. spool is (encoded, tags, ext) for the spool to take
+        # over if the job still hasn't run when ComfyUI exits
+        self.start()
+        self.queue.put((job, spool), timeout=timeout)
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def run(self):
+        while True:
+            job, spool = self.queue.get()
+            try:
+                job()
+            except Exception as e:
+                print("{} Background import failed: {}".format(hydrus_logging_prefix, e))
+            finally:
+                self.queue.task_done()
+
+    def flush(self, timeout=None):
+        # Wait for everything queued so far to reach Hydrus. Returns False if the timeout ran out first
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def take_pending(self):
+        # Everything that hasn't started yet, taken off the queue. Returns each job's spool arguments
+        taken = []
+        while True:
+            try:
+                job, spool = self.queue.get_nowait()
+            except queue.Empty:
+                return taken
+            self.queue.task_done()
+            taken.append(spool)
+
+upload_queue = HydrusUploadQueue(upload_queue_size)
+
+def get_upload_queue_depth():
+    return upload_queue.depth()
+
+@atexit.register
+def flush_upload_queue():
+    # Don't lose queued images when ComfyUI shuts down
+    depth = upload_queue.depth()
+    if depth:
+        print("{} Flushing {} queued batch(es) to Hydrus before exit...".format(hydrus_logging_prefix, depth))
+    if upload_queue.flush(timeout=upload_flush_timeout):
+        return
+    # Hydrus is down or slow, don't hold up the exit. Batches that haven't started go to the spool, which replays
+    # them after the restart
+    spooled = dropped = 0
+    for spool in upload_queue.take_pending():
+        if spool is None:
+            dropped += 1
+            continue
+        try:
+            import_spool.put(*spool, start=False)
+            spooled += 1
+        except OSError as e:
+            print("{} Couldn't spool a queued batch: {}".format(hydrus_logging_prefix, e))
+            dropped += 1
+    print("{} Hydrus didn't take the queued images within {}s: spooled {} batch(es), dropped {}, and the upload in progress was cut off".format(
+        hydrus_logging_prefix, upload_flush_timeout, spooled, dropped))
+
+class SpooledFile:
+    # Looks enough like a HashingBuffer for import_batch, but the bytes live in the spool
+    def __init__(self, path, hash):
+        self.path = path
+        self.hash = hash
+
+    def hexdigest(self):
+        return self.hash
+
+    def reader(self):
+        return self
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+class HydrusSpool:
+    # Durable spool so imports don't depend on Hydrus being up. Files are stored by their sha256 and a journal of
+    # "add"/"done" lines keeps track of what still has to go to Hydrus, so a restart picks up where it left off.
+    # Files Hydrus refuses to import are moved to failed/ with their tags instead of being thrown away.
+    BATCH_SIZE = 16
+    MAX_BACKOFF = 300
+
+    def __init__(self, directory, workers=2):
+        self.directory = directory
+        self.files_dir = os.path.join(directory, "files")
+        self.failed_dir = os.path.join(directory, "failed")
+        self.journal_path = os.path.join(directory, "journal.jsonl")
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.worker = None
+        # hash -> journal entry, loaded from the journal the first time it's needed
+        self.pending = None
+
+    def load(self):
+        # Caller holds the lock
+        if self.pending is not None:
+            return
+        self.pending = {}
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Half written line from a crash, it was never acknowledged so there's nothing to lose
+                    continue
+                if entry["op"] == "add":
+                    self.pending[entry["hash"]] = entry
+                elif entry["op"] == "done":
+                    self.pending.pop(entry["hash"], None)
+
+    def append(self, entries):
+        # Caller holds the lock. Nothing counts as spooled until it's fsynced
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.journal_path, "a") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def path(self, entry):
+        return os.path.join(self.files_dir, entry["hash"] + entry["ext"])
+
+    def put(self, encoded, tags, ext=".png", start=True):
+        # The files are written under the lock too, otherwise a replay finishing in between could delete a file
+        # that's already there right after this decided not to write it again
+        with self.lock:
+            self.load()
+            os.makedirs(self.files_dir, exist_ok=True)
+            entries = []
+            for imagefile, size in encoded:
+                entry = {"op": "add", "hash": imagefile.hexdigest(), "ext": ext, "tags": list(tags)}
+                path = self.path(entry)
+                if not os.path.exists(path):
+                    with open(path + ".tmp", "wb") as f:
+                        f.write(imagefile.getbuffer())
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(path + ".tmp", path)
+                # Same image spooled twice (same seed and settings), keep the tags from both
+                previous = self.pending.get(entry["hash"])
+                if previous is not None:
+                    entry["tags"] = previous["tags"] + [tag for tag in entry["tags"] if tag not in previous["tags"]]
+                entries.append(entry)
+            self.append(entries)
+            for entry in entries:
+                self.pending[entry["hash"]] = entry
+        # start=False leaves the replay for later, e.g. at exit where no new threads can be started
+        if start:
+            self.start()
+            self.wake.set()
+
+    def depth(self):
+        with self.lock:
+            self.load()
+            return len(self.pending)
+
+    def pending_batches(self):
+        # Files with the same tags go together so they share the existence check and the add_tags call
+        with self.lock:
+            self.load()
+            groups = {}
+            for entry in self.pending.values():
+                groups.setdefault(tuple(entry["tags"]), []).append(entry)
+        batches = []
+        for entries in groups.values():
+            for i in range(0, len(entries), self.BATCH_SIZE):
+                batches.append(entries[i:i + self.BATCH_SIZE])
+        return batches
+
+    def mark_done(self, entries, failed=()):
+        # failed is (entry, note) for files Hydrus wouldn't take, those are kept in failed/ rather than deleted
+        notes = {entry["hash"]: note for entry, note in failed}
+        entries = list(entries) + [entry for entry, note in failed]
+        with self.lock:
+            # If the same image got spooled again while this was replaying, leave the newer entry pending
+            entries = [entry for entry in entries if self.pending.get(entry["hash"]) is entry]
+            if not entries:
+                return
+            self.append([{"op": "done", "hash": entry["hash"]} for entry in entries])
+            for entry in entries:
+                del self.pending[entry["hash"]]
+                try:
+                    if entry["hash"] in notes:
+                        self.keep_failed(entry, notes[entry["hash"]])
+                    else:
+                        os.remove(self.path(entry))
+                except FileNotFoundError:
+                    pass
+            if not self.pending:
+                # Everything made it, start the journal over so it doesn't grow forever
+                os.remove(self.journal_path)
+
+    def keep_failed(self, entry, note):
+        # Caller holds the lock. The file goes next to a .json with its tags and why Hydrus refused it
+        os.makedirs(self.failed_dir, exist_ok=True)
+        os.replace(self.path(entry), os.path.join(self.failed_dir, entry["hash"] + entry["ext"]))
+        with open(os.path.join(self.failed_dir, entry["hash"] + ".json"), "w") as f:
+            json.dump({"tags": entry["tags"], "note": note}, f)
+        print("{} Hydrus wouldn't import spooled image {}, kept it in {}: {}".format(hydrus_logging_prefix, entry["hash"], self.failed_dir, note))
+
+    def replay(self, batch):
+        missing = [entry for entry in batch if not os.path.exists(self.path(entry))]
+        if missing:
+            print("{} {} spooled file(s) went missing, skipping them".format(hydrus_logging_prefix, len(missing)))
+            self.mark_done(missing)
+            batch = [entry for entry in batch if entry not in missing]
+            if not batch:
+                return True
+        try:
+            client = get_hydrus_client()
+            files = [(SpooledFile(self.path(entry), entry["hash"]), os.path.getsize(self.path(entry))) for entry in batch]
+            results = HydrusImport().import_batch(client, files, batch[0]["tags"])
+        except Exception as e:
+            print("{} Couldn't replay spooled images, will try again: {}".format(hydrus_logging_prefix, e))
+            return False
+        if results == 404:
+            return False
+        # import_batch has one result per file, in order
+        failed = [(entry, result.get("note", "")) for entry, result in zip(batch, results)
+                  if result["status"] in (ImportStatus.FAILED, ImportStatus.VETOED)]
+        failed_hashes = {entry["hash"] for entry, note in failed}
+        self.mark_done([entry for entry in batch if entry["hash"] not in failed_hashes], failed)
+        return True
+
+    def drain(self):
+        # One pass over everything pending, returns True when it all went through
+        batches = self.pending_batches()
+        if not batches:
+            return True
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hydrus-spool") as pool:
+            return all(list(pool.map(self.replay, batches)))
+
+    def run(self):
+        backoff = 1
+        while True:
+            if self.drain():
+                backoff = 1
+                self.wake.wait()
+                self.wake.clear()
+            else:
+                # Hydrus is down or busy, wait a bit longer each time
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.MAX_BACKOFF)
+
+    def start(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name="hydrus-spool-replay", daemon=True)
+                self.worker.start()
+
+import_spool = HydrusSpool(spool_dir, spool_workers)
+
+def get_spool_depth():
+    return import_spool.depth()
+
+if os.path.exists(import_spool.journal_path):
+    # Left over from before a restart
+    import_spool.start()
+
+class CheckpointCache:
+    # LRU of loaded (model, clip, vae) tuples keyed by checkpoint path, so exporting a pile of images from the same
+    # model only loads it once. Sizes go by the file on disk, which is close enough to what it takes up loaded.
+    # The most recent checkpoint always stays, even if it's bigger than the budget on its own.
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, ckpt_path, loader):
+        with self.lock:
+            if ckpt_path in self.entries:
+                self.entries.move_to_end(ckpt_path)
+                self.hits += 1
+                return self.entries[ckpt_path][0]
+            self.misses += 1
+        out = loader(ckpt_path)
+        try:
+            size = os.path.getsize(ckpt_path)
+        except (OSError, TypeError):
+            size = 0
+        with self.lock:
+            if ckpt_path not in self.entries:
+                self.entries[ckpt_path] = (out, size)
+                self.total_bytes += size
+            while self.total_bytes > self.budget_bytes and len(self.entries) > 1:
+                evicted, (evicted_out, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                print("{} Dropped {} from the checkpoint cache".format(hydrus_logging_prefix, evicted))
+        return out
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "checkpoints": len(self.entries), "bytes": self.total_bytes}
+
+checkpoint_cache = CheckpointCache(int(checkpoint_cache_gb * 1024 ** 3))
+
+class GenerationIndex:
+    # hash -> parsed generation tags (plus every tag the file had), kept in SQLite so exports and submit.py can
+    # answer "what was this made with" without asking Hydrus. Which files have a tag is refreshed per tag.
+    # Filled in at import time, and sync() picks up generated files that got into Hydrus some other way and drops
+    # the ones deleted there.
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS files (hash TEXT PRIMARY KEY, modelname TEXT, positive TEXT, negative TEXT, seed TEXT, loras TEXT, indexed_at REAL)",
+        "CREATE TABLE IF NOT EXISTS file_tags (tag TEXT, hash TEXT, PRIMARY KEY (tag, hash))",
+        "CREATE INDEX IF NOT EXISTS files_by_model ON files (modelname COLLATE NOCASE)",
+        "CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)",
+        # sha256 of files in the input directory, only trusted while the size and mtime still match
+        "CREATE TABLE IF NOT EXISTS local_hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def connect(self):
+        # Caller holds the lock. Opened on first use so importing the module doesn't create the file
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            try:
+                for statement in self.SCHEMA:
+                    connection.execute(statement)
+                connection.commit()
+            except sqlite3.Error:
+                connection.close()
+                raise
+            # Only kept once the schema is all there, so a failure gets tried again from scratch next time
+            self.connection = connection
+        return self.connection
+
+    def record_many(self, records):
+        # records is hash -> (parsed generation tags, all tags)
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                for hash, (record, tags) in records.items():
+                    connection.execute(
+                        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (hash, record.get('modelname'), record.get('positive'), record.get('negative'), record.get('seed'), json.dumps(record.get('loras', [])), now),
+                    )
+                    connection.execute("DELETE FROM file_tags WHERE hash = ?", (hash,))
+                    connection.executemany("INSERT OR IGNORE INTO file_tags VALUES (?, ?)", [(normalize_tag(tag), hash) for tag in tags if tag.strip()])
+
+    def lookup(self, hashes):
+        # Same shape as HydrusExport.get_files_metadata, only for the hashes the index knows
+        records = {}
+        hashes = list(hashes)
+        with self.lock:
+            connection = self.connect()
+            for i in range(0, len(hashes), METADATA_CHUNK_SIZE):
+                chunk = hashes[i:i + METADATA_CHUNK_SIZE]
+                rows = connection.execute(
+                    "SELECT hash, modelname, positive, negative, seed, loras FROM files WHERE hash IN ({})".format(",".join("?" * len(chunk))), chunk
+                )
+                for hash, modelname, positive, negative, seed, loras in rows:
+                    record = {'loras': json.loads(loras)}
+                    for key, value in (('modelname', modelname), ('positive', positive), ('negative', negative), ('seed', seed)):
+                        if value is not None:
+                            record[key] = value
+                    records[hash] = record
+        return records
+
+    def hashes_for_tag(self, tag):
+        with self.lock:
+            rows = self.connect().execute("SELECT hash FROM file_tags WHERE tag = ? ORDER BY hash", (normalize_tag(tag),))
+            return [row[0] for row in rows]
+
+    def cached_hash(self, path, size, mtime_ns):
+        with self.lock:
+            row = self.connect().execute("SELECT hash FROM local_hashes WHERE path = ? AND size = ? AND mtime_ns = ?", (path, size, mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def remember_hash(self, path, size, mtime_ns, hash):
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO local_hashes VALUES (?, ?, ?, ?)", (path, size, mtime_ns, hash))
+
+    def last_sync(self):
+        with self.lock:
+            row = self.connect().execute("SELECT value FROM sync_state WHERE key = 'last_sync'").fetchone()
+        return float(row[0]) if row else 0
+
+    def refresh_tag(self, client, tag):
+        # Tags like tobeupscaled get added and removed in Hydrus all the time, so which files have one is asked
+        # fresh with a single search, and this tag's rows are replaced with the answer
+        hashes = client.search_files([tag], return_hashes=True, return_file_ids=False)['hashes']
+        tag = normalize_tag(tag)
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("DELETE FROM file_tags WHERE tag = ?", (tag,))
+                connection.executemany("INSERT OR IGNORE INTO file_tags VALUES (?, ?)", [(tag, hash) for hash in hashes])
+        return self.hashes_for_tag(tag)
+
+    def forget_all_but(self, hashes):
+        # Drops every file not in hashes, returns how many went
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("CREATE TEMP TABLE IF NOT EXISTS live (hash TEXT PRIMARY KEY)")
+                connection.execute("DELETE FROM live")
+                connection.executemany("INSERT OR IGNORE INTO live VALUES (?)", [(hash,) for hash in hashes])
+                removed = connection.execute("DELETE FROM files WHERE hash NOT IN (SELECT hash FROM live)").rowcount
+                connection.execute("DELETE FROM file_tags WHERE hash NOT IN (SELECT hash FROM live)")
+                connection.execute("DELETE FROM live")
+        return removed
+
+    def sync(self, client):
+        # Every generated file has a modelname tag, so that one search lists everything that belongs in the index.
+        # Files that dropped out of it (deleted in Hydrus) are dropped here too, and only files the index hasn't
+        # seen (or only has part of) get their metadata fetched. Tag membership is kept up to date per tag by refresh_tag
+        tag_service = get_hydrus_service_key(client)
+        hashes = client.search_files(["modelname:*"], return_hashes=True, return_file_ids=False)['hashes']
+        removed = self.forget_all_but(hashes)
+        known = self.lookup(hashes)
+        hashes = [hash for hash in hashes if not all(field in known.get(hash, {}) for field in EXPORT_FIELDS)]
+        records = {}
+        for i in range(0, len(hashes), METADATA_CHUNK_SIZE):
+            for metadata in client.get_file_metadata(hashes=hashes[i:i + METADATA_CHUNK_SIZE])['metadata']:
+                tags = metadata.get('tags', {}).get(tag_service, {}).get('display_tags', {}).get('0', [])
+                records[metadata['hash']] = (parse_generation_tags(tags), tags)
+        self.record_many(records)
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO sync_state VALUES ('last_sync', ?)", (str(time.time()),))
+        print("{} Indexed {} new file(s) from Hydrus, dropped {} it no longer has".format(hydrus_logging_prefix, len(records), removed))
+        return len(records)
+
+    def sync_if_due(self, client):
+        if time.time() - self.last_sync() >= index_sync_interval:
+            self.sync(client)
+
+generation_index = GenerationIndex(index_path)
+
+class FileCache:
+    # Files in Hydrus never change, so once a hash has been downloaded it can be read from disk from then on.
+    # Stored as <dir>/<first two hex chars>/<hash>. Reading bumps the mtime, and the oldest mtimes go first once
+    # the cache is over its size cap, which keeps it least recently used across restarts too.
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = None
+
+    def path(self, hash):
+        # The hash can come straight from the node's text box, so it has to be a sha256 before it becomes a path
+        if not re.fullmatch('[0-9a-f]{64}', hash):
+            raise ValueError("Not a sha256 hash: {!r}".format(hash))
+        return os.path.join(self.directory, hash[:2], hash)
+
+    def contains(self, hash):
+        try:
+            return self.max_bytes > 0 and os.path.exists(self.path(hash.lower()))
+        except ValueError:
+            return False
+
+    def open(self, hash):
+        # A read-only mmap of the cached file, or None if it isn't cached
+        if self.max_bytes <= 0:
+            return None
+        hash = hash.lower()
+        try:
+            with open(self.path(hash), "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(self.path(hash))
+        except (OSError, ValueError):
+            # Not there, or empty (can't mmap nothing)
+            return None
+        return data
+
+    def put(self, hash, data):
+        if self.max_bytes <= 0 or len(data) > self.max_bytes:
+            return False
+        hash = hash.lower()
+        if hashlib.sha256(data).hexdigest() != hash:
+            print("{} Download for {} doesn't match its hash, not caching it".format(hydrus_logging_prefix, hash))
+            return False
+        path = self.path(hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock:
+            if os.path.exists(path):
+                return True
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+            if self.total_bytes is not None:
+                self.total_bytes += len(data)
+            self.evict()
+        return True
+
+    def entries(self):
+        files = []
+        for root, dirs, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        return files
+
+    def evict(self):
+        # Caller holds the lock
+        if self.total_bytes is None:
+            self.total_bytes = sum(size for mtime, size, path in self.entries())
+        if self.total_bytes <= self.max_bytes:
+            return
+        for mtime, size, path in sorted(self.entries()):
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.total_bytes -= size
+
+file_cache = FileCache(file_cache_dir, int(file_cache_gb * 1024 ** 3))
+
+prefetch_pool = ThreadPoolExecutor(max_workers=max(prefetch_depth, 1), thread_name_prefix="hydrus-prefetch")
+# Hashes being downloaded for a later run right now, so quick re-runs don't fetch the same file twice
+prefetching = set()
+prefetch_lock = threading.Lock()
 
 class HydrusExport:
     def __init__(self):
@@ -80,16 +939,18 @@ class HydrusExport:
     @classmethod
     def INPUT_TYPES(cls):
         input_dir = folder_paths.get_input_directory()
-        files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
+        files = list_input_files(input_dir)
         return {
                     "required": {
                     },
                     "optional": {
-                        "images": (sorted(files), {"image_upload": False},),
+                        "images": (files, {"image_upload": False},),
                         "tag": ("STRING",{"default": '', "multiline": False, "forceInput": True},),
                         "hash": ("STRING",{"default": '', "multiline": False, "forceInput": True},),
                         "usetag": ("BOOLEAN", {"default": False},),
-                        "usehash": ("BOOLEAN", {"default": False},)
+                        "usehash": ("BOOLEAN", {"default": False},),
+                        "tag_mode": (TAG_MODES, {"default": "first"},),
+                        "use_index": ("BOOLEAN", {"default": False},),
                     },
                     "hidden": {
                     },
@@ -105,40 +966,83 @@ class HydrusExport:
     CATEGORY = "image"
     # I had this in Hydrus originally, honestly smarter to just have it alongside the other image savers
 
+    # (tag, tag_mode) -> where that tag got up to, so "next" and "batch" carry on across runs
+    cursors = {}
+
+    @classmethod
+    def IS_CHANGED(cls, images="", tag="", hash="", usehash=False, usetag=False, tag_mode="first", use_index=False):
+        if usetag and tag_mode != "first":
+            # The cursor moves every run, so ComfyUI can never reuse the last output
+            return float("NaN")
+        return ""
+
+    def next_position(self, key, items):
+        # The cursor remembers the last item handed out, not its position. The list is read again every run and
+        # files drop out of a tag as they get processed, so a position would skip or repeat files when it shifts.
+        # If the last item is gone, start from the top
+        last = self.cursors.get(key)
+        position = items.index(last) + 1 if last in items else 0
+        if position >= len(items):
+            print("{} Reached the end of {}, starting over".format(hydrus_logging_prefix, key[0]))
+            position = 0
+        self.cursors[key] = items[position]
+        return position
+
     def get_files_with_tag(self, tag):
-        hash_list = []
-        file_ids = self.client.search_files([tag])['file_ids']
-        files_metadata = self.client.get_file_metadata(file_ids=file_ids)['metadata']
-        for individual_file in files_metadata:
-            hash_list.append(individual_file['hash'])
-        return hash_list
+        # The search can hand back hashes itself, so there's no metadata request just to turn file ids into hashes
+        return self.client.search_files([tag], return_hashes=True, return_file_ids=False)['hashes']
 
-    def get_file_metadata(self, hash):
-        metadata = self.client.get_file_metadata(hashes={hash})['metadata'][0]
+    def get_files_metadata(self, hashes):
+        # Parsed generation tags for a whole list of hashes. The local index answers what it can, Hydrus gets asked
+        # for the rest in a handful of requests instead of one per file
+        hashes = list(hashes)
+        try:
+            records = generation_index.lookup(hashes)
+        except sqlite3.Error as e:
+            # No usable index (read-only directory, bad path, locked or broken file), Hydrus has everything anyway
+            print("{} Couldn't read the local index, asking Hydrus: {}".format(hydrus_logging_prefix, e))
+            records = {}
+        # A row from a file whose tags didn't parse (or that's missing a prompt) doesn't count, Hydrus may know more
+        records = {hash: record for hash, record in records.items() if all(field in record for field in EXPORT_FIELDS)}
+        missing = [hash for hash in hashes if hash not in records]
+        if not missing:
+            return records
         tag_service = get_hydrus_service_key(self.client)
-        tags = metadata['tags'][tag_service]['display_tags']['0']
-        outputs = {}
-        outputs['loras'] = []
-        for i in tags:
-            if 'modelname:' in i:
-                outputs['modelname'] = i.replace('modelname:','')
-            if 'positive:' in i:
-                outputs['positive'] = i.replace('positive:','')
-            if 'negative:' in i:
-                outputs['negative'] = i.replace('negative:','')
-            if 'seed:' in i:
-                outputs['seed'] = i.replace('seed:','')
-            if 'lora:' in i:
-                outputs['loras'].append(i.replace('lora:',''))
-        return outputs
+        fetched = {}
+        for i in range(0, len(missing), METADATA_CHUNK_SIZE):
+            chunk = missing[i:i + METADATA_CHUNK_SIZE]
+            for metadata in self.client.get_file_metadata(hashes=chunk)['metadata']:
+                tags = metadata.get('tags', {}).get(tag_service, {}).get('display_tags', {}).get('0', [])
+                records[metadata['hash']] = parse_generation_tags(tags)
+                fetched[metadata['hash']] = (records[metadata['hash']], tags)
+        try:
+            generation_index.record_many(fetched)
+        except sqlite3.Error as e:
+            print("{} Couldn't update the local index: {}".format(hydrus_logging_prefix, e))
+        return records
+
+    def get_file_metadata(self, hash):
+        # Hydrus hands hashes back in lower case, so don't count on the key matching what was typed in
+        return list(self.get_files_metadata([hash]).values())[0]
 
     def get_file(self, hash):
         file = self.client.get_file(hash)
         response = file.content
+        file_cache.put(hash, response)
         return response
 
+    def open_file(self, hash):
+        # The cached copy if there is one, otherwise download it (which also caches it for next time)
+        cached = file_cache.open(hash)
+        if cached is not None:
+            return cached
+        return io.BytesIO(self.get_file(hash))
+
     def checkpointer(self, ckpt_name=""):
         ckpt_path = folder_paths.get_full_path('checkpoints', ckpt_name)
+        return checkpoint_cache.get(ckpt_path, self.load_checkpoint)
+
+    def load_checkpoint(self, ckpt_path):
         out = sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True)
         new_out = list(out)
         new_out.pop()
@@ -152,40 +1056,122 @@ class HydrusExport:
         filename = ".".join(filename)
         return filename
 
+    def decode_image(self, fp):
+        # Decode straight out of the downloaded bytes (or the mmapped cache), and go from uint8 to float in one pass
+        # into the output tensor
+        with fp:
+            img = Image.open(fp)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            pixels = np.asarray(img)
+        image = torch.empty((1, ) + pixels.shape, dtype=torch.float32, pin_memory=pin_memory and torch.cuda.is_available())
+        np.divide(pixels, np.float32(255.0), out=image.numpy()[0])
+        return image
+
+    def load_image(self, hash):
+        return self.decode_image(self.open_file(hash))
+
+    def prefetch_images(self, hashes):
+        # Downloads for the first few hashes start right away, and each decoded image lets another one start, so
+        # the network stays busy while images are decoded and passed on. At most prefetch_depth files wait in memory
+        hashes = iter(hashes)
+        pending = deque()
+        def fill():
+            while len(pending) < max(prefetch_depth, 1):
+                hash = next(hashes, None)
+                if hash is None:
+                    return
+                pending.append(prefetch_pool.submit(self.open_file, hash))
+        fill()
+        def images():
+            while pending:
+                fp = pending.popleft().result()
+                fill()
+                yield self.decode_image(fp)
+        return images()
+
+    def prefetch_file(self, hash):
+        try:
+            self.get_file(hash)
+        except Exception as e:
+            print("{} Couldn't prefetch {}: {}".format(hydrus_logging_prefix, hash, e))
+        finally:
+            with prefetch_lock:
+                prefetching.discard(hash)
+
+    def prefetch(self, hashes):
+        # Get the next runs' files into the file cache and their metadata into the index without waiting on them.
+        # Without the file cache there's nowhere to keep the downloads, so don't bother
+        if not hashes or file_cache.max_bytes <= 0:
+            return
+        prefetch_pool.submit(self.get_files_metadata, hashes)
+        for hash in hashes:
+            with prefetch_lock:
+                if hash in prefetching or file_cache.contains(hash):
+                    continue
+                prefetching.add(hash)
+            prefetch_pool.submit(self.prefetch_file, hash)
+
     def prep_image(self, hash):
         tags = self.get_file_metadata(hash)
         model = '{}.safetensors'.format(tags['modelname'])
         # add something to search the models directory
         out = self.checkpointer(model)
-        hydrus = TemporaryFile()
-        hydrus_file = self.get_file(hash)
-        hydrus.write(hydrus_file)
-        img = Image.open(hydrus)
-        image = img.convert("RGB")
-        image = np.array(image).astype(np.float32) / 255.0
-        image = torch.from_numpy(image)[None,]
+        image = self.load_image(hash)
         image_tuple = (image, )
         model_tuple = out
         tag_tuple = (tags['positive'], tags['negative'], tags['modelname'], tags['seed'], tags['loras'])
         returned = image_tuple + model_tuple + tag_tuple
         return returned
 
-    def export_from_hydrus(self, images="", tag="", hash="", usehash=False, usetag=False):
-        return_batch = []
+    def prep_batch(self, hash_list, tag):
+        # Group by model so every image in the batch really was made with the model that comes out with it,
+        # and each model gets loaded once. One model per run, the cursor moves on to the next model each time
+        groups = OrderedDict()
+        records = self.get_files_metadata(hash_list)
+        for hash in hash_list:
+            tags = records[hash]
+            groups.setdefault(tags['modelname'], []).append((hash, tags))
+        models = list(groups)
+        modelname = models[self.next_position((tag, "batch"), models)]
+        members = groups[modelname]
+        print("{} Exporting {} image(s) made with {}".format(hydrus_logging_prefix, len(members), modelname))
+        # Start downloading before the checkpoint loads so the two overlap
+        images = self.prefetch_images([hash for hash, tags in members])
+        out = self.checkpointer('{}.safetensors'.format(modelname))
+        image = stack_images(list(images))
+        # The prompts and seed can only be one string, so they come from the first image
+        tags = members[0][1]
+        tag_tuple = (tags['positive'], tags['negative'], tags['modelname'], tags['seed'], tags['loras'])
+        return (image, ) + out + tag_tuple
+
+    def export_from_hydrus(self, images="", tag="", hash="", usehash=False, usetag=False, tag_mode="first", use_index=False):
         if usetag:
-            hash_list = self.get_files_with_tag(tag)
-            for hash in hash_list:
-                return_batch.append(self.prep_image(hash))
+            if use_index:
+                # Generation metadata comes from the local index, which catches up with Hydrus every so often.
+                # Which files have the tag is the part that changes, so that's asked fresh every time
+                generation_index.sync_if_due(self.client)
+                hash_list = generation_index.refresh_tag(self.client, tag)
+            else:
+                hash_list = self.get_files_with_tag(tag)
+            if not hash_list:
+                raise ValueError("No files in Hydrus have the tag {}".format(tag))
+            # Only prepare what actually gets returned
+            if tag_mode == "batch":
+                return self.prep_batch(hash_list, tag)
+            if tag_mode == "next":
+                position = self.next_position((tag, "next"), hash_list)
+                self.prefetch(hash_list[position + 1:position + 1 + prefetch_depth])
+                return self.prep_image(hash_list[position])
+            return self.prep_image(hash_list[0])
         elif usehash:
-            return_batch.append(self.prep_image(hash))
+            return self.prep_image(hash)
         else:
             image_path = folder_paths.get_annotated_filepath(images, './')
             # The SDBatch Loader I'm using is weird, defaulting this to './' allowed to be pulled from input/ToBeUpscaled
             print("{} Image: {}".format(hydrus_logging_prefix, images))
-            with open(image_path,'rb') as file:
-                hash = hashlib.sha256(file.read()).hexdigest()
-                return_batch.append(self.prep_image(hash))
-        return return_batch[0]
+            hash = hash_file(image_path)
+            return self.prep_image(hash)
 
 class HydrusDuplicates:
     def __init__(self):
@@ -222,20 +1208,53 @@ class HydrusDuplicates:
 #    }
 #}
 
+    def parse_hashes(self, hashes):
+        # One hash, or several separated by newlines/commas/spaces, or a list straight from another node.
+        # Lower case, like Hydrus hands them back
+        if isinstance(hashes, (list, tuple)):
+            return [str(i).strip().lower() for i in hashes if str(i).strip()]
+        return hashes.lower().replace(',', ' ').split()
+
+    def wait_for_files(self, client, hashes, timeout):
+        # The files might still be on their way in (async uploads, spool), so poll until Hydrus knows every hash
+        # instead of sleeping a fixed amount. Returns whichever hashes still aren't there when time runs out
+        deadline = time.monotonic() + timeout
+        delay = 0.1
+        missing = {hash.lower() for hash in hashes}
+        while True:
+            metadata = client.get_file_metadata(hashes=sorted(missing), only_return_identifiers=True)['metadata']
+            missing -= {i['hash'] for i in metadata if i.get('file_id') is not None}
+            remaining = deadline - time.monotonic()
+            if not missing or remaining <= 0:
+                return missing
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 2)
+
     def dedupe(self, original_hash="", upscaled_hash=""):
         client = get_hydrus_client()
-        time.sleep(5)
-        print("Orig: {}".format(original_hash))
-        print("Upscale: {}".format(upscaled_hash))
+        originals = self.parse_hashes(original_hash)
+        upscales = self.parse_hashes(upscaled_hash)
+        print("Orig: {}".format(originals))
+        print("Upscale: {}".format(upscales))
+        if len(originals) != len(upscales):
+            print("{} Got {} original hash(es) but {} upscaled hash(es), they need to pair up".format(hydrus_logging_prefix, len(originals), len(upscales)))
+            return None
+        missing = self.wait_for_files(client, set(originals + upscales), dedupe_timeout)
+        if missing:
+            print("{} Hydrus still doesn't have {} after {}s, skipping those pairs".format(hydrus_logging_prefix, ", ".join(sorted(missing)), dedupe_timeout))
         body = [
             {
-                "hash_a": original_hash,
-                "hash_b": upscaled_hash,
+                "hash_a": original,
+                "hash_b": upscaled,
                 "relationship": 4,
                 "do_default_content_merge": True
             }
+            for original, upscaled in zip(originals, upscales)
+            if original not in missing and upscaled not in missing
         ]
         print("Body: {}".format(body))
+        if not body:
+            return None
 
         results = client.set_file_relationships(body)
         return results
@@ -258,6 +1277,12 @@ class HydrusImport:
                         "loras": ("STRING",{"default": "", "forceInput": False},),
                         "tags": ("STRING",{"default": "ai, comfyui, hyshare: ai", "forceInput": True},),
                         "dedupe": ("BOOLEAN", {"default": False},),
+                        "async_upload": ("BOOLEAN", {"default": False},),
+                        "spool": ("BOOLEAN", {"default": False},),
+                        "local_path_import": ("BOOLEAN", {"default": False},),
+                        "compression": (COMPRESSION_LEVELS, {"default": "optimize"},),
+                        "file_format": (FILE_FORMATS, {"default": "PNG"},),
+                        "compress_metadata": ("BOOLEAN", {"default": False},),
                     },
                     "hidden": {
                         "prompt": "PROMPT",
@@ -275,7 +1300,7 @@ class HydrusImport:
     CATEGORY = "image"
     # I had this in Hydrus originally, honestly smarter to just have it alongside the other image savers
 
-    def import_to_hydrus(self, images, positive="", negative="", modelname="", seed="", loras="", tags="", dedupe=False, prompt=None, extra_pnginfo=None):
+    def import_to_hydrus(self, images, positive="", negative="", modelname="", seed="", loras="", tags="", dedupe=False, async_upload=False, spool=False, local_path_import=False, compression="optimize", file_format="PNG", compress_metadata=False, prompt=None, extra_pnginfo=None):
         client = get_hydrus_client()
         imagelist = []
         split = tags.split(',')
@@ -295,57 +1320,156 @@ class HydrusImport:
 
         metatags = meta + split
         
-        for index, image in enumerate(images):
-            # From this line down to metadata.add_text is shamelessly stolen from the wlsh save with metadata node
-            image_quantity = len(images)
-            # Programmer things. Indicies start at 0, but "importing 0 out of n) doesnt make sense
-            image_index = index + 1
-            comment = ""
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            # Setting up PNG metadata
-            metadata = PngInfo()
-            
-            if prompt is not None:
-                metadata.add_text("prompt", json.dumps(prompt))
-            if extra_pnginfo is not None:
-                for x in extra_pnginfo:
-                    metadata.add_text(x, json.dumps(extra_pnginfo[x]))
-            metadata.add_text("parameters", comment)
-            metadata.add_text("comment", comment)
-            imagefile = TemporaryFile()
-            img.save(imagefile, "PNG", comment=comment, pnginfo=metadata, optimize=True)
-            # File gets saved, and the temp file requires seeking to "reset" back to the start of file
-            imagefile.seek(0)
-            print("{} Importing Image {} out of {}...".format(hydrus_logging_prefix, image_index, image_quantity))
-            self.import_image(imagefile, client, metatags)
-            # After import, the file (yet again) is read, so needs to be reset
-            imagefile.seek(0)
-            hash = hashlib.sha256(imagefile.read()).hexdigest()
-            if dedupe:
-                #Deduplication should only occur with one image because I'm cringe and don't know what I'm doing
-                return hash
+        if compression == "auto":
+            level = compression_tuner.choose(file_format)
+            print("{} Auto compression picked level {}".format(hydrus_logging_prefix, level))
+        else:
+            level = compression
+        pixel_batch = images_to_uint8(images)
+        if dedupe:
+            #Deduplication should only occur with one image because I'm cringe and don't know what I'm doing
+            pixel_batch = pixel_batch[:1]
+        # The workflow is the same for every image, so it only gets serialized once per batch
+        metadata = self.build_pnginfo(prompt, extra_pnginfo, compress_metadata)
+        # Every image in the batch gets encoded at once
+        encoded = list(encode_pool.map(functools.partial(self.encode_image, metadata=metadata, file_format=file_format, compression=level), pixel_batch))
+        if spool:
+            import_spool.put(encoded, metatags, ".{}".format(file_format.lower()))
+            print("{} Spooled {} image(s) ({} waiting for Hydrus)".format(hydrus_logging_prefix, len(encoded), import_spool.depth()))
+        elif async_upload:
+            upload_queue.put(functools.partial(self.import_batch, client, encoded, metatags, local_path=local_path_import),
+                             spool=(encoded, metatags, ".{}".format(file_format.lower())))
+            print("{} Queued {} image(s) (queue depth {})".format(hydrus_logging_prefix, len(encoded), upload_queue.depth()))
+        else:
+            self.import_batch(client, encoded, metatags, local_path=local_path_import)
+        if dedupe:
+            return encoded[0][0].hexdigest()
         # This doesn't return a preview of the image, I'm not sure wtf I'm doing wrong. Maybe it needs to be the img, w/e idk
         return imagelist
 
 
-    def add_and_tag(self, client, image, tags, tag_service_key):
-        hash = ""
-        result = client.add_file(image)
-        # How is the file service chosen? Trick question, it's default!
-        # TODO: let the file service(s) be an input
-        if result["status"] != ImportStatus.FAILED:
-            hash = result["hash"]
-        client.add_tags(hashes=[hash], service_keys_to_tags={tag_service_key: tags})
-        print("{} Done!".format(hydrus_logging_prefix))
-        return result
+    def build_pnginfo(self, prompt=None, extra_pnginfo=None, compress=False):
+        # From this line down to metadata.add_text is shamelessly stolen from the wlsh save with metadata node
+        # compress stores the chunks as zTXt, big workflows shrink a lot and still read back the same
+        comment = ""
+        metadata = PngInfo()
+
+        if prompt is not None:
+            metadata.add_text("prompt", json.dumps(prompt), zip=compress)
+        if extra_pnginfo is not None:
+            for x in extra_pnginfo:
+                metadata.add_text(x, json.dumps(extra_pnginfo[x]), zip=compress)
+        metadata.add_text("parameters", comment)
+        metadata.add_text("comment", comment)
+        return metadata
 
-    def import_image(self, image, client, tags=None):
-        if not hydrus_api.utils.verify_permissions(client, REQUIRED_PERMISSIONS):
+    def encode_image(self, pixels, metadata=None, file_format="PNG", compression="optimize"):
+        start = time.perf_counter()
+        img = Image.fromarray(pixels)
+        imagefile = HashingBuffer()
+        if file_format == "WEBP":
+            # Lossless WebP has nowhere to put the PNG text chunks, so the workflow only lives on in the Hydrus tags
+            method = 6 if compression == "optimize" else int(compression) * 6 // 9
+            img.save(imagefile, "WEBP", lossless=True, method=method)
+        elif compression == "optimize":
+            img.save(imagefile, "PNG", pnginfo=metadata, optimize=True)
+        else:
+            img.save(imagefile, "PNG", pnginfo=metadata, compress_level=int(compression))
+        size = imagefile.tell()
+        if compression != "optimize":
+            compression_tuner.record_encode(file_format, int(compression), pixels.nbytes, size, time.perf_counter() - start)
+        imagefile.seek(0)
+        return imagefile, size
+
+    def known_hashes(self, client, hashes):
+        # One metadata call for the whole batch, anything Hydrus already has doesn't need to be uploaded again
+        try:
+            metadata = client.get_file_metadata(hashes=hashes)['metadata']
+        except hydrus_api.HydrusAPIException as e:
+            print("{} Couldn't check for existing files, uploading everything: {}".format(hydrus_logging_prefix, e))
+            return set()
+        return {i['hash'] for i in metadata if i.get('file_id') is not None and i.get('is_local') and not i.get('is_trashed')}
+
+    def import_batch(self, client, encoded, tags=None, image_tags=None, local_path=False):
+        # image_tags optionally lines up with encoded, for tags that only belong on one image
+        # local_path hands Hydrus a path in the shared directory instead of uploading the bytes
+        if not verify_hydrus_permissions(client):
             print("{} The API key does not grant all required permissions: {}".format(hydrus_logging_prefix, REQUIRED_PERMISSIONS))
             return 404
         tag_service_key = get_hydrus_service_key(client)
-        result = self.add_and_tag(client, image, tags, tag_service_key)
+        image_quantity = len(encoded)
+        known = self.known_hashes(client, [imagefile.hexdigest() for imagefile, size in encoded])
+        results = []
+        tagged = {}
+        for index, (imagefile, size) in enumerate(encoded):
+            # Programmer things. Indicies start at 0, but "importing 0 out of n) doesnt make sense
+            image_index = index + 1
+            hash = imagefile.hexdigest()
+            if hash in known:
+                print("{} Hydrus already has Image {} out of {}, only adding tags...".format(hydrus_logging_prefix, image_index, image_quantity))
+                results.append({"status": ImportStatus.EXISTS, "hash": hash})
+            else:
+                print("{} Importing Image {} out of {}...".format(hydrus_logging_prefix, image_index, image_quantity))
+                result = None
+                if local_path:
+                    result = self.add_file_by_path(client, imagefile)
+                if result is None:
+                    # Time the round-trip so auto compression knows how fast Hydrus takes bytes
+                    start = time.perf_counter()
+                    # How is the file service chosen? Trick question, it's default!
+                    # TODO: let the file service(s) be an input
+                    result = client.add_file(imagefile.reader())
+                    compression_tuner.record_upload(size, time.perf_counter() - start)
+                results.append(result)
+                if result["status"] == ImportStatus.FAILED:
+                    print("{} Hydrus failed to import Image {}: {}".format(hydrus_logging_prefix, image_index, result.get("note", "")))
+                    continue
+                hash = result["hash"]
+            all_tags = list(tags or [])
+            if image_tags is not None:
+                all_tags += list(image_tags[index])
+            tagged.setdefault(tuple(all_tags), []).append(hash)
+        # Hydrus puts the same tags on every hash in an add_tags call, so images sharing their tags share one call.
+        # Without per-image tags that's a single call for the whole batch
+        for all_tags, hashes in tagged.items():
+            if all_tags:
+                client.add_tags(hashes=hashes, service_keys_to_tags={tag_service_key: list(all_tags)})
+        try:
+            # Index the tags the way Hydrus stores them, so the model and prompts match what a sync would record
+            normalized = {all_tags: [normalize_tag(tag) for tag in all_tags] for all_tags in tagged}
+            generation_index.record_many({hash: (parse_generation_tags(normalized[all_tags]), normalized[all_tags]) for all_tags, hashes in tagged.items() for hash in hashes})
+        except sqlite3.Error as e:
+            print("{} Couldn't update the local index: {}".format(hydrus_logging_prefix, e))
+        print("{} Done!".format(hydrus_logging_prefix))
+        return results
+
+    def add_file_by_path(self, client, imagefile):
+        # Returns None whenever the path route doesn't work out, so the caller can upload the bytes instead
+        if not shared_dir:
+            print("{} HYDRUS_SHARED_DIR isn't set, uploading instead".format(hydrus_logging_prefix))
+            return None
+        hash = imagefile.hexdigest()
+        local_file = os.path.join(shared_dir, hash)
+        try:
+            with open(local_file, "wb") as f:
+                f.write(imagefile.reader().read())
+        except OSError as e:
+            print("{} Couldn't write to the shared directory, uploading instead: {}".format(hydrus_logging_prefix, e))
+            return None
+        try:
+            result = client.add_file(os.path.join(shared_dir_remote, hash))
+        except hydrus_api.HydrusAPIException as e:
+            print("{} Hydrus couldn't import from the shared directory, uploading instead: {}".format(hydrus_logging_prefix, e))
+            result = None
+        finally:
+            # Hydrus copies the file into its own storage, ours isn't needed either way
+            try:
+                os.remove(local_file)
+            except OSError:
+                pass
+        if result is not None and result["status"] == ImportStatus.FAILED:
+            print("{} Hydrus couldn't import from the shared directory, uploading instead: {}".format(hydrus_logging_prefix, result.get("note", "")))
+            return None
         return result
 
 NODE_CLASS_MAPPINGS = {
@@ -0,0 +1,10 @@
+# Shared by the node and submit.py, so it can't import anything from ComfyUI
+
+def normalize_tag(tag):
+    # The way Hydrus stores a tag: trimmed, lower case, and no spaces around the namespace colon. "hyshare: ai" and
+    # "Hyshare:ai" are both "hyshare:ai" once they're in Hydrus, so anything matching tags locally has to agree
+    tag = tag.strip().lower()
+    namespace, colon, subtag = tag.partition(':')
+    if not colon:
+        return tag
+    return namespace.rstrip() + ':' + subtag.lstrip()
@@ -1,34 +1,309 @@
+import argparse
 import json
 import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import hydrus_api
 import requests
+from requests.adapters import HTTPAdapter
+from hydrus_tags import normalize_tag
 
-with open("upscale_workflow.json", "r") as file:
-    prompt = json.loads(file.read())
+METADATA_CHUNK_SIZE = 100
+# Times a job is tried on a failing host before it's counted as failed
+MAX_ATTEMPTS = 3
 
-tag = "tobeupscaledbeta"
-
-key = os.environ.get("HYDRUS_KEY")
-url = os.environ.get("HYDRUS_URL")
-client = hydrus_api.Client(key, url)
+script_dir = os.path.dirname(os.path.realpath(__file__))
+index_path = os.environ.get("HYDRUS_INDEX_PATH", os.path.join(script_dir, "hydrus_index.sqlite3"))
 
 def get_files_with_tag(tag, client):
-    hash_list = []
-    file_ids = client.search_files([tag])['file_ids']
-    files_metadata = client.get_file_metadata(file_ids=file_ids)['metadata']
-    for individual_file in files_metadata:
-        hash_list.append(individual_file['hash'])
-    return hash_list
+    # The search hands back hashes itself, no need to look up metadata just to turn file ids into hashes
+    return client.search_files([tag], return_hashes=True, return_file_ids=False)['hashes']
+
+def get_model(metadata):
+    # The modelname: tag from whichever tag service has it; the node writes it to just one
+    for service in metadata.get('tags', {}).values():
+        for tag in service.get('display_tags', {}).get('0', []):
+            namespace, colon, value = normalize_tag(tag).partition(':')
+            if colon and namespace == 'modelname':
+                return value
+    return None
+
+def get_models(client, hashes):
+    # Checkpoint of every hash, asked for a chunk at a time instead of once per file
+    models = {}
+    for i in range(0, len(hashes), METADATA_CHUNK_SIZE):
+        for metadata in client.get_file_metadata(hashes=hashes[i:i + METADATA_CHUNK_SIZE])['metadata']:
+            models[metadata['hash']] = get_model(metadata)
+    return models
+
+def get_models_from_index(hashes, path):
+    # Read-only, so a wrong path doesn't leave an empty database behind. Any trouble and Hydrus gets asked instead
+    try:
+        connection = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    except sqlite3.Error as e:
+        print("Couldn't open the index at {}, asking Hydrus: {}".format(path, e))
+        return {}
+    try:
+        models = {}
+        for i in range(0, len(hashes), METADATA_CHUNK_SIZE):
+            chunk = hashes[i:i + METADATA_CHUNK_SIZE]
+            query = "SELECT hash, modelname FROM files WHERE hash IN ({})".format(",".join("?" * len(chunk)))
+            models.update(connection.execute(query, chunk).fetchall())
+        return models
+    except sqlite3.Error as e:
+        print("Couldn't read the index at {}, asking Hydrus: {}".format(path, e))
+        return {}
+    finally:
+        connection.close()
+
+def order_by_model(hashes, models, max_consecutive=0):
+    # Jobs that use the same checkpoint go back to back so ComfyUI doesn't swap models between prompts. Models keep
+    # the order they first show up in, files without a known model go last. With max_consecutive set, models take
+    # turns in runs of at most that many jobs so one big model can't hold up the rest
+    groups = {}
+    for hash in hashes:
+        groups.setdefault(models.get(hash), []).append(hash)
+    if None in groups:
+        groups[None] = groups.pop(None)
+    if max_consecutive <= 0:
+        return [hash for group in groups.values() for hash in group]
+    ordered = []
+    queues = [deque(group) for group in groups.values()]
+    while queues:
+        for queue in queues:
+            for _ in range(min(max_consecutive, len(queue))):
+                ordered.append(queue.popleft())
+        queues = [queue for queue in queues if queue]
+    return ordered
+
+def make_session(pool_size, hosts=1):
+    # One session for the whole run so every post reuses a kept-alive connection
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max(hosts, 1), pool_maxsize=max(pool_size, 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def with_hash(prompt, node, hash):
+    # Copy just the path down to the input so concurrent jobs don't share the dict they change
+    job = dict(prompt)
+    job[node] = dict(prompt[node], inputs=dict(prompt[node]['inputs'], hash=hash))
+    return job
+
+def queue_prompt(session, host, prompt, timeout=30):
+    data = json.dumps({"prompt": prompt}).encode('utf-8')
+    resp = session.post("{}/prompt".format(host), data=data, timeout=timeout)
+    resp.raise_for_status()
+    try:
+        return resp.json()
+    except ValueError:
+        # It was accepted all the same, a body that isn't JSON (a proxy's, say) doesn't make it a failure
+        return resp.text
+
+def get_queue_depth(session, host, timeout=10):
+    queue = session.get("{}/queue".format(host), timeout=timeout).json()
+    return len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+
+def load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path, "r") as file:
+        return {line.strip() for line in file if line.strip()}
+
+class Checkpoint:
+    # Hashes that made it into ComfyUI's queue, one per line, so a rerun can pick up where the last one stopped
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def add(self, hash):
+        if not self.path:
+            return
+        with self.lock, open(self.path, "a") as file:
+            file.write(hash + "\n")
+
+class ComfyHost:
+    # What submit knows about one ComfyUI node. depth is its queue as of the last poll plus whatever was sent since
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.depth = 0
+        self.in_flight = 0
+        self.last_model = None
+
+    def refresh(self, session):
+        # Polling the queue doubles as the health check. A host that doesn't answer gets nothing new until it does
+        try:
+            # Posts still on their way count too, the queue might not show them yet
+            self.depth = get_queue_depth(session, self.url) + self.in_flight
+        except (requests.RequestException, ValueError) as e:
+            if self.healthy:
+                print("{} isn't answering, not sending it anything: {}".format(self.url, e))
+            self.healthy = False
+            return
+        if not self.healthy:
+            print("{} is back".format(self.url))
+        self.healthy = True
+
+    def room(self, watermark, concurrency):
+        if not self.healthy:
+            return 0
+        return min(watermark - self.depth, concurrency - self.in_flight)
+
+def pick_host(hosts, model, watermark, concurrency):
+    # The shortest queue with room left, but a host that already has this checkpoint loaded goes first
+    available = [host for host in hosts if host.room(watermark, concurrency) > 0]
+    if not available:
+        return None
+    same_model = [host for host in available if model is not None and host.last_model == model]
+    return min(same_model or available, key=lambda host: (host.depth, host.in_flight))
+
+def submit_all(session, hosts, prompt, node, hashes, checkpoint, models=None, concurrency=4, watermark=8, poll_interval=2.0,
+               max_wait=300.0):
+    # Only top each host's queue up to the watermark, so thousands of jobs don't all sit in ComfyUI's memory at once.
+    # concurrency caps the posts in flight per host. Once every host has been down for max_wait seconds (0 waits for
+    # good) the rest are given up on and left out of the checkpoint
+    hosts = [ComfyHost(url) for url in hosts]
+    models = models or {}
+    pending = deque(hashes)
+    running = {}
+    attempts = {}
+    submitted = failed = abandoned = 0
+    last_poll = None
+    down_since = None
+    # Set when posts finish, so the next time every host looks full their queues get read again straight away
+    posted = False
+
+    def submit(host, hash):
+        print(queue_prompt(session, host.url, with_hash(prompt, node, hash)))
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1) * len(hosts)) as pool:
+        while pending or running:
+            # Poll when every host looks full by our own count. They only ever drain, so the count is on the safe side
+            full = not any(host.room(watermark, concurrency) > 0 for host in hosts)
+            if last_poll is None or (full and (posted or time.monotonic() - last_poll >= poll_interval)):
+                for host in hosts:
+                    host.refresh(session)
+                last_poll = time.monotonic()
+                posted = False
+
+            if running or any(host.healthy for host in hosts):
+                down_since = None
+            elif down_since is None:
+                down_since = time.monotonic()
+            elif max_wait > 0 and time.monotonic() - down_since >= max_wait:
+                abandoned = len(pending)
+                print("No host has answered for {:.0f}s, giving up on the last {} job(s)".format(max_wait, abandoned))
+                break
+
+            while pending:
+                model = models.get(pending[0])
+                host = pick_host(hosts, model, watermark, concurrency)
+                if host is None:
+                    break
+                hash = pending.popleft()
+                host.depth += 1
+                host.in_flight += 1
+                host.last_model = model
+                running[pool.submit(submit, host, hash)] = (host, hash)
+
+            if not running:
+                time.sleep(poll_interval)
+                continue
+            done, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            posted = posted or bool(done)
+            for future in done:
+                host, hash = running.pop(future)
+                host.in_flight -= 1
+                try:
+                    future.result()
+                except requests.RequestException as e:
+                    # It never made it into the queue, as far as we know
+                    host.depth -= 1
+                    response = getattr(e, "response", None)
+                    if response is not None:
+                        # ComfyUI answered. A 4xx means it turned the prompt down, sending it elsewhere won't help
+                        retry = response.status_code >= 500
+                    else:
+                        # No answer. Only safe to send again if the connection never got made: after a read timeout
+                        # ComfyUI may well have queued it already
+                        retry = isinstance(e, requests.ConnectionError)
+                    attempts[hash] = attempts.get(hash, 0) + 1
+                    if not retry or attempts[hash] >= MAX_ATTEMPTS:
+                        print("Couldn't queue {}: {}".format(hash, e))
+                        failed += 1
+                        continue
+                    # The host went away or broke, hand the job to one of the others
+                    if host.healthy:
+                        print("{} isn't answering, not sending it anything: {}".format(host.url, e))
+                    host.healthy = False
+                    pending.appendleft(hash)
+                else:
+                    checkpoint.add(hash)
+                    submitted += 1
+    return submitted, failed, abandoned
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Queue a ComfyUI workflow once for every Hydrus file with a tag")
+    parser.add_argument("--tag", default="tobeupscaledbeta", help="Hydrus tag to search for")
+    parser.add_argument("--workflow", default="upscale_workflow.json", help="Workflow in ComfyUI's API format")
+    parser.add_argument("--node", default="59", help="Id of the Hydrus Export node in the workflow")
+    parser.add_argument("--host", action="append", dest="hosts",
+                        help="ComfyUI address, give it more than once to spread jobs over several (default: $COMFYUI_URL, comma separated)")
+    parser.add_argument("--concurrency", type=int, default=4, help="How many prompts to post at once to each host")
+    parser.add_argument("--watermark", type=int, default=8, help="Queue depth to keep each host at")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds between queue checks while it's full")
+    parser.add_argument("--max-wait", type=float, default=300.0,
+                        help="Seconds to wait with every host down before giving up on the rest (0 to wait for good)")
+    parser.add_argument("--checkpoint", help="File of already queued hashes to skip and add to (default: submitted-<tag>.txt)")
+    parser.add_argument("--no-group-by-model", dest="group_by_model", action="store_false",
+                        help="Queue files in search order instead of grouping them by checkpoint")
+    parser.add_argument("--max-per-model", type=int, default=0,
+                        help="Most jobs with the same checkpoint to queue in a row before letting another model in (0 for no limit)")
+    parser.add_argument("--use-index", action="store_true", default=os.environ.get("HYDRUS_USE_INDEX") == "1",
+                        help="Read the files' models from the node's local index instead of asking Hydrus")
+    args = parser.parse_args(argv)
+    if args.checkpoint is None:
+        args.checkpoint = "submitted-{}.txt".format(args.tag)
+    if not args.hosts:
+        args.hosts = os.environ.get("COMFYUI_URL", "http://10.0.0.4:8188").split(",")
+    args.hosts = [host.strip().rstrip("/") for host in args.hosts if host.strip()]
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.workflow, "r") as file:
+        prompt = json.loads(file.read())
+
+    # Which files have the tag always comes from Hydrus, the index can lag behind tags added or removed there
+    client = hydrus_api.Client(os.environ.get("HYDRUS_KEY"), os.environ.get("HYDRUS_URL"))
+    hash_list = get_files_with_tag(args.tag, client)
 
-def queue_prompt(prompt):
-    p = {"prompt": prompt}
-    data = json.dumps(p).encode('utf-8')
-    resp =  requests.post("http://10.0.0.4:8188/prompt", data=data)
-    print(resp.text)
+    done = load_checkpoint(args.checkpoint)
+    hashes = [hash for hash in hash_list if hash not in done]
+    print("Queueing {} file(s), skipping {} already queued".format(len(hashes), len(hash_list) - len(hashes)))
 
-hash_list = get_files_with_tag(tag, client)
+    models = None
+    if args.group_by_model and hashes:
+        models = {}
+        if args.use_index:
+            models = {hash: model for hash, model in get_models_from_index(hashes, index_path).items() if model}
+        # Anything the index doesn't have a model for gets asked of Hydrus
+        missing = [hash for hash in hashes if hash not in models]
+        if missing:
+            models.update(get_models(client, missing))
+        hashes = order_by_model(hashes, models, args.max_per_model)
 
-for i in hash_list:
-    prompt['59']['inputs']['hash'] = i
-    queue_prompt(prompt)
+    session = make_session(args.concurrency * len(args.hosts), len(args.hosts))
+    submitted, failed, abandoned = submit_all(session, args.hosts, prompt, args.node, hashes, Checkpoint(args.checkpoint),
+                                              models, args.concurrency, args.watermark, args.poll_interval, args.max_wait)
+    print("Queued {}, {} failed, {} not sent".format(submitted, failed, abandoned))
+    if abandoned:
+        sys.exit(1)
 
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,9 @@ from PIL import Image
 from tempfile import TemporaryFile
 import json
 import hashlib
+import os
 
-from hydrus_node import HydrusImport, HydrusExport, HydrusDuplicates
+from hydrus_node import HydrusImport, HydrusExport, HydrusDuplicates, HydrusUploadQueue
 
 
 class TestHydrusImport:
@@ -36,52 +37,314 @@ class TestHydrusImport:
     
     @patch('hydrus_node.get_hydrus_client')
     @patch('hydrus_node.hydrus_api.utils.verify_permissions')
-    @patch('hydrus_node.get_hydrus_service_key')
-    def test_import_image_success(self, mock_get_service_key, mock_verify_perms, mock_get_client, mock_hydrus_client):
-        """Test successful image import"""
+    def test_import_batch_no_permissions(self, mock_verify_perms, mock_get_client, mock_hydrus_client):
+        """Test importing with insufficient permissions uploads nothing"""
+        mock_get_client.return_value = mock_hydrus_client
+        mock_verify_perms.return_value = False
+        hydrus_import = HydrusImport()
+        encoded = [hydrus_import.encode_image(np.zeros((8, 8, 3), dtype=np.uint8), compression="0")]
+
+        result = hydrus_import.import_batch(mock_hydrus_client, encoded, ["tag1"])
+
+        assert result == 404
+        mock_hydrus_client.add_file.assert_not_called()
+
+    @patch('hydrus_node.get_hydrus_client')
+    @patch('hydrus_node.upload_queue')
+    def test_import_to_hydrus_async(self, mock_queue, mock_get_client, mock_hydrus_client, sample_image_tensor):
+        """Test async mode hands the image to the upload queue instead of importing inline"""
+        mock_get_client.return_value = mock_hydrus_client
+        mock_queue.depth.return_value = 1
+
+        hydrus_import = HydrusImport()
+        hydrus_import.import_batch = Mock()
+        result = hydrus_import.import_to_hydrus(sample_image_tensor, tags="ai", dedupe=True, async_upload=True)
+
+        mock_queue.put.assert_called_once()
+        hydrus_import.import_batch.assert_not_called()
+        assert len(result) == 64
+
+    def test_encode_image_png_levels(self):
+        """Test PNG encoding at an explicit compression level keeps the metadata"""
+        hydrus_import = HydrusImport()
+        pixels = np.random.randint(0, 255, (32, 32, 3), dtype=np.uint8)
+
+        metadata = hydrus_import.build_pnginfo(prompt={"1": "node"})
+        imagefile, size = hydrus_import.encode_image(pixels, metadata=metadata, compression="1")
+
+        data = imagefile.read()
+        assert len(data) == size
+        img = Image.open(imagefile)
+        assert img.format == "PNG"
+        assert json.loads(img.text["prompt"]) == {"1": "node"}
+        np.testing.assert_array_equal(np.array(img), pixels)
+
+    def test_build_pnginfo_compressed(self):
+        """Test compressed metadata is stored as zTXt, smaller, and reads back the same"""
+        hydrus_import = HydrusImport()
+        pixels = np.zeros((8, 8, 3), dtype=np.uint8)
+        prompt = {str(i): {"inputs": {"text": "a very repetitive prompt " * 20}} for i in range(20)}
+        extra_pnginfo = {"workflow": {"nodes": list(range(500))}}
+
+        plain, plain_size = hydrus_import.encode_image(pixels, metadata=hydrus_import.build_pnginfo(prompt, extra_pnginfo), compression="6")
+        packed, packed_size = hydrus_import.encode_image(pixels, metadata=hydrus_import.build_pnginfo(prompt, extra_pnginfo, compress=True), compression="6")
+
+        assert b"zTXtprompt" in packed.getvalue()
+        assert packed_size < plain_size
+        img = Image.open(packed)
+        assert json.loads(img.text["prompt"]) == prompt
+        assert json.loads(img.text["workflow"]) == extra_pnginfo["workflow"]
+
+    @patch('hydrus_node.get_hydrus_client')
+    @patch('hydrus_node.hydrus_api.utils.verify_permissions')
+    def test_import_to_hydrus_builds_pnginfo_once(self, mock_verify_perms, mock_get_client, mock_hydrus_client):
+        """Test the PNG metadata is built once for the whole batch"""
         mock_get_client.return_value = mock_hydrus_client
         mock_verify_perms.return_value = True
-        mock_get_service_key.return_value = "test_service_key"
-        
         hydrus_import = HydrusImport()
-        
-        # Mock the add_and_tag method
-        hydrus_import.add_and_tag = Mock(return_value={"status": 1, "hash": "test_hash"})
-        
-        result = hydrus_import.import_image("fake_image_data", mock_hydrus_client, ["tag1", "tag2"])
-        
-        assert result == {"status": 1, "hash": "test_hash"}
-        hydrus_import.add_and_tag.assert_called_once()
-    
+        hydrus_import.build_pnginfo = Mock(wraps=hydrus_import.build_pnginfo)
+
+        hydrus_import.import_to_hydrus(torch.rand(3, 8, 8, 3), tags="ai", compression="0", prompt={"1": "node"})
+
+        hydrus_import.build_pnginfo.assert_called_once_with({"1": "node"}, None, False)
+        assert mock_hydrus_client.add_file.call_count == 3
+
+    def test_encode_image_webp_lossless(self):
+        """Test WebP output is lossless"""
+        hydrus_import = HydrusImport()
+        pixels = np.random.randint(0, 255, (32, 32, 3), dtype=np.uint8)
+
+        imagefile, size = hydrus_import.encode_image(pixels, file_format="WEBP", compression="3")
+
+        img = Image.open(imagefile)
+        assert img.format == "WEBP"
+        np.testing.assert_array_equal(np.array(img.convert("RGB")), pixels)
+
     @patch('hydrus_node.get_hydrus_client')
     @patch('hydrus_node.hydrus_api.utils.verify_permissions')
-    def test_import_image_no_permissions(self, mock_verify_perms, mock_get_client, mock_hydrus_client):
-        """Test image import with insufficient permissions"""
+    def test_import_to_hydrus_uploads_from_memory(self, mock_verify_perms, mock_get_client, mock_hydrus_client, sample_image_tensor):
+        """Test the encoded bytes go to add_file as a memoryview and the returned hash matches them"""
         mock_get_client.return_value = mock_hydrus_client
-        mock_verify_perms.return_value = False
-        
+        mock_verify_perms.return_value = True
+        uploaded = []
+        mock_hydrus_client.add_file.side_effect = lambda image: uploaded.append(image.read()) or {"status": 1, "hash": "new_hash"}
+
         hydrus_import = HydrusImport()
-        result = hydrus_import.import_image("fake_image_data", mock_hydrus_client, ["tag1"])
-        
-        assert result == 404
-    
+        result = hydrus_import.import_to_hydrus(sample_image_tensor, tags="ai", dedupe=True)
+
+        assert isinstance(uploaded[0], memoryview)
+        assert result == hashlib.sha256(uploaded[0]).hexdigest()
+
     @patch('hydrus_node.get_hydrus_client')
-    def test_add_and_tag(self, mock_get_client, mock_hydrus_client):
-        """Test add_and_tag method"""
+    @patch('hydrus_node.compression_tuner')
+    @patch('hydrus_node.hydrus_api.utils.verify_permissions')
+    def test_import_to_hydrus_auto_compression(self, mock_verify_perms, mock_tuner, mock_get_client, mock_hydrus_client, sample_image_tensor):
+        """Test auto compression asks the tuner for a level and encodes with it"""
         mock_get_client.return_value = mock_hydrus_client
-        mock_hydrus_client.add_file.return_value = {"status": 1, "hash": "new_hash"}
-        
+        mock_verify_perms.return_value = True
+        mock_tuner.choose.return_value = 3
+
         hydrus_import = HydrusImport()
-        result = hydrus_import.add_and_tag(mock_hydrus_client, "image_data", ["tag1", "tag2"], "service_key")
-        
-        mock_hydrus_client.add_file.assert_called_once_with("image_data")
+        hydrus_import.import_to_hydrus(sample_image_tensor, tags="ai", compression="auto")
+
+        mock_tuner.choose.assert_called_once_with("PNG")
+        assert mock_tuner.record_encode.call_args[0][:2] == ("PNG", 3)
+        mock_tuner.record_upload.assert_called_once()
+        mock_hydrus_client.add_file.assert_called_once()
+
+    @patch('hydrus_node.hydrus_api.utils.verify_permissions')
+    def test_import_batch_skips_known_files(self, mock_verify_perms, mock_hydrus_client):
+        """Test files Hydrus already has only get tagged, and the rest get uploaded"""
+        mock_verify_perms.return_value = True
+        hydrus_import = HydrusImport()
+        encoded = [hydrus_import.encode_image(np.full((8, 8, 3), value, dtype=np.uint8), compression="0") for value in (0, 255)]
+        known_hash = encoded[0][0].hexdigest()
+        new_hash = encoded[1][0].hexdigest()
+        mock_hydrus_client.get_file_metadata.return_value = {'metadata': [
+            {'hash': known_hash, 'file_id': 1, 'is_local': True, 'is_trashed': False},
+            {'hash': new_hash, 'file_id': None},
+        ]}
+        mock_hydrus_client.add_file.return_value = {"status": 1, "hash": new_hash}
+
+        results = hydrus_import.import_batch(mock_hydrus_client, encoded, ["tag1"])
+
+        mock_hydrus_client.get_file_metadata.assert_called_once_with(hashes=[known_hash, new_hash])
+        mock_hydrus_client.add_file.assert_called_once()
+        assert [result["hash"] for result in results] == [known_hash, new_hash]
+
+    @patch('hydrus_node.hydrus_api.utils.verify_permissions')
+    def test_import_batch_tags_in_one_call(self, mock_verify_perms, mock_hydrus_client):
+        """Test the whole batch is tagged with a single add_tags call"""
+        mock_verify_perms.return_value = True
+        hydrus_import = HydrusImport()
+        encoded = [hydrus_import.encode_image(np.full((8, 8, 3), value, dtype=np.uint8), compression="0") for value in (0, 100, 255)]
+        mock_hydrus_client.add_file.side_effect = [{"status": 1, "hash": "hash{}".format(i)} for i in range(3)]
+
+        hydrus_import.import_batch(mock_hydrus_client, encoded, ["tag1", "tag2"])
+
+        assert mock_hydrus_client.add_file.call_count == 3
         mock_hydrus_client.add_tags.assert_called_once_with(
-            hashes=["new_hash"], 
-            service_keys_to_tags={"service_key": ["tag1", "tag2"]}
+            hashes=["hash0", "hash1", "hash2"],
+            service_keys_to_tags={"test_service_key": ["tag1", "tag2"]}
         )
-        assert result == {"status": 1, "hash": "new_hash"}
+
+    @patch('hydrus_node.hydrus_api.utils.verify_permissions')
+    def test_import_batch_per_image_tags(self, mock_verify_perms, mock_hydrus_client):
+        """Test per-image tags are merged, and images with the same tags still share a call"""
+        mock_verify_perms.return_value = True
+        hydrus_import = HydrusImport()
+        encoded = [hydrus_import.encode_image(np.full((8, 8, 3), value, dtype=np.uint8), compression="0") for value in (0, 100, 255)]
+        mock_hydrus_client.add_file.side_effect = [{"status": 1, "hash": "hash{}".format(i)} for i in range(3)]
+
+        hydrus_import.import_batch(mock_hydrus_client, encoded, ["tag1"], image_tags=[[], ["extra"], []])
+
+        assert mock_hydrus_client.add_tags.call_count == 2
+        mock_hydrus_client.add_tags.assert_any_call(hashes=["hash0", "hash2"], service_keys_to_tags={"test_service_key": ["tag1"]})
+        mock_hydrus_client.add_tags.assert_any_call(hashes=["hash1"], service_keys_to_tags={"test_service_key": ["tag1", "extra"]})
+
+    @patch('hydrus_node.hydrus_api.utils.verify_permissions')
+    def test_import_batch_failed_import_not_tagged(self, mock_verify_perms, mock_hydrus_client):
+        """Test a file Hydrus failed to import isn't tagged"""
+        mock_verify_perms.return_value = True
+        hydrus_import = HydrusImport()
+        encoded = [hydrus_import.encode_image(np.zeros((8, 8, 3), dtype=np.uint8), compression="0")]
+        mock_hydrus_client.add_file.return_value = {"status": 4, "hash": "bad_hash", "note": "broken"}
+
+        hydrus_import.import_batch(mock_hydrus_client, encoded, ["tag1"])
+
+        mock_hydrus_client.add_tags.assert_not_called()
+
+    @patch('hydrus_node.hydrus_api.utils.verify_permissions')
+    def test_import_batch_metadata_error_uploads_everything(self, mock_verify_perms, mock_hydrus_client):
+        """Test a failed pre-flight check falls back to uploading"""
+        import hydrus_api
+        mock_verify_perms.return_value = True
+        mock_hydrus_client.get_file_metadata.side_effect = hydrus_api.HydrusAPIException("nope")
+        hydrus_import = HydrusImport()
+        encoded = [hydrus_import.encode_image(np.zeros((8, 8, 3), dtype=np.uint8), compression="0")]
+
+        hydrus_import.import_batch(mock_hydrus_client, encoded, ["tag1"])
+
+        mock_hydrus_client.add_file.assert_called_once()
 
 
+    @patch('hydrus_node.hydrus_api.utils.verify_permissions')
+    def test_import_batch_local_path(self, mock_verify_perms, mock_hydrus_client, tmp_path):
+        """Test local path mode hands Hydrus a path in the shared directory and cleans it up"""
+        mock_verify_perms.return_value = True
+        hydrus_import = HydrusImport()
+        encoded = [hydrus_import.encode_image(np.zeros((8, 8, 3), dtype=np.uint8), compression="0")]
+        hash = encoded[0][0].hexdigest()
+        seen = {}
+        def add_file(path):
+            seen[path] = (tmp_path / hash).read_bytes()
+            return {"status": 1, "hash": hash}
+        mock_hydrus_client.add_file.side_effect = add_file
+
+        with patch('hydrus_node.shared_dir', str(tmp_path)), patch('hydrus_node.shared_dir_remote', "/hydrus/shared"):
+            hydrus_import.import_batch(mock_hydrus_client, encoded, ["tag1"], local_path=True)
+
+        assert seen == {os.path.join("/hydrus/shared", hash): encoded[0][0].getvalue()}
+        assert not (tmp_path / hash).exists()
+        mock_hydrus_client.add_tags.assert_called_once()
+
+    @patch('hydrus_node.hydrus_api.utils.verify_permissions')
+    def test_import_batch_local_path_fallback(self, mock_verify_perms, mock_hydrus_client, tmp_path):
+        """Test an unreachable path falls back to uploading the bytes"""
+        import hydrus_api
+        mock_verify_perms.return_value = True
+        hydrus_import = HydrusImport()
+        encoded = [hydrus_import.encode_image(np.zeros((8, 8, 3), dtype=np.uint8), compression="0")]
+        mock_hydrus_client.add_file.side_effect = [hydrus_api.HydrusAPIException("no such file"), {"status": 1, "hash": "new_hash"}]
+
+        with patch('hydrus_node.shared_dir', str(tmp_path)), patch('hydrus_node.shared_dir_remote', "/not/mounted"):
+            results = hydrus_import.import_batch(mock_hydrus_client, encoded, ["tag1"], local_path=True)
+
+        assert mock_hydrus_client.add_file.call_count == 2
+        assert isinstance(mock_hydrus_client.add_file.call_args[0][0], type(encoded[0][0].reader()))
+        assert results == [{"status": 1, "hash": "new_hash"}]
+        assert not os.listdir(tmp_path)
+
+    @patch('hydrus_node.hydrus_api.utils.verify_permissions')
+    def test_import_batch_local_path_not_configured(self, mock_verify_perms, mock_hydrus_client):
+        """Test local path mode without a shared directory just uploads"""
+        mock_verify_perms.return_value = True
+        hydrus_import = HydrusImport()
+        encoded = [hydrus_import.encode_image(np.zeros((8, 8, 3), dtype=np.uint8), compression="0")]
+
+        with patch('hydrus_node.shared_dir', None):
+            hydrus_import.import_batch(mock_hydrus_client, encoded, ["tag1"], local_path=True)
+
+        mock_hydrus_client.add_file.assert_called_once()
+        assert not isinstance(mock_hydrus_client.add_file.call_args[0][0], str)
+
+
+class TestHydrusUploadQueue:
+
+    def test_put_runs_job_and_flush(self):
+        """Test queued jobs run on the worker and flush waits for them"""
+        upload_queue = HydrusUploadQueue(maxsize=4)
+        job = Mock()
+
+        upload_queue.put(job)
+
+        assert upload_queue.flush(timeout=5)
+        job.assert_called_once()
+        assert upload_queue.depth() == 0
+
+    def test_failed_job_does_not_kill_worker(self):
+        """Test an exception in one job doesn't stop later jobs"""
+        upload_queue = HydrusUploadQueue(maxsize=4)
+        job = Mock()
+
+        upload_queue.put(Mock(side_effect=Exception("Hydrus is down")))
+        upload_queue.put(job)
+
+        assert upload_queue.flush(timeout=5)
+        job.assert_called_once()
+
+    def test_backpressure_when_full(self):
+        """Test put blocks (and times out) while the queue is full"""
+        import queue
+        import threading
+        upload_queue = HydrusUploadQueue(maxsize=1)
+        release = threading.Event()
+
+        upload_queue.put(release.wait)
+        # Wait for the worker to pick up the blocking job, then fill the only slot
+        while upload_queue.depth():
+            pass
+        upload_queue.put(Mock())
+
+        with pytest.raises(queue.Full):
+            upload_queue.put(Mock(), timeout=0.05)
+        assert not upload_queue.flush(timeout=0.05)
+
+        release.set()
+        assert upload_queue.flush(timeout=5)
+
+
+    def test_exit_flush_spools_what_is_left(self):
+        """Test the exit flush gives up after its timeout and hands unstarted batches to the spool"""
+        import threading
+        from hydrus_node import flush_upload_queue
+        upload_queue = HydrusUploadQueue(maxsize=4)
+        release = threading.Event()
+        upload_queue.put(release.wait)
+        while upload_queue.depth():
+            pass
+        upload_queue.put(Mock(), spool=("encoded", ["tag1"], ".png"))
+        upload_queue.put(Mock())
+
+        with patch('hydrus_node.upload_queue', upload_queue), patch('hydrus_node.upload_flush_timeout', 0.05), \
+                patch('hydrus_node.import_spool') as mock_spool, patch('builtins.print') as mock_print:
+            flush_upload_queue()
+
+        mock_spool.put.assert_called_once_with("encoded", ["tag1"], ".png", start=False)
+        assert "spooled 1 batch(es), dropped 1" in mock_print.call_args[0][0]
+        assert upload_queue.depth() == 0
+        release.set()
+
 class TestHydrusExport:
     
     @patch('hydrus_node.get_hydrus_client')
@@ -92,13 +355,12 @@ class TestHydrusExport:
         assert hydrus_export.client == mock_hydrus_client
     
     @patch('hydrus_node.folder_paths.get_input_directory')
-    @patch('os.listdir')
-    @patch('os.path.isfile')
-    def test_input_types(self, mock_isfile, mock_listdir, mock_get_input_dir):
+    def test_input_types(self, mock_get_input_dir, tmp_path):
         """Test INPUT_TYPES class method"""
-        mock_get_input_dir.return_value = "/fake/input"
-        mock_listdir.return_value = ["image1.png", "image2.jpg", "subfolder"]
-        mock_isfile.side_effect = lambda x: x.endswith(('.png', '.jpg'))
+        mock_get_input_dir.return_value = str(tmp_path)
+        (tmp_path / "image2.jpg").write_bytes(b"")
+        (tmp_path / "image1.png").write_bytes(b"")
+        (tmp_path / "subfolder").mkdir()
         
         input_types = HydrusExport.INPUT_TYPES()
         
@@ -107,6 +369,27 @@ class TestHydrusExport:
         assert "images" in input_types["optional"]
         assert "tag" in input_types["optional"]
         assert "hash" in input_types["optional"]
+        assert input_types["optional"]["images"][0] == ["image1.png", "image2.jpg"]
+
+    def test_input_listing_cached_until_dir_changes(self, tmp_path):
+        """Test the listing is reused while the directory's mtime stays the same"""
+        from hydrus_node import list_input_files
+        (tmp_path / "a.png").write_bytes(b"")
+        os.utime(tmp_path, ns=(10 ** 9, 10 ** 9))
+
+        assert list_input_files(str(tmp_path)) == ["a.png"]
+        with patch('os.scandir', side_effect=AssertionError("listed again")):
+            assert list_input_files(str(tmp_path)) == ["a.png"]
+
+        (tmp_path / "b.png").write_bytes(b"")
+        os.utime(tmp_path, ns=(2 * 10 ** 9, 2 * 10 ** 9))
+        assert list_input_files(str(tmp_path)) == ["a.png", "b.png"]
+
+    def test_input_listing_missing_dir(self, tmp_path):
+        """Test a missing input directory lists nothing"""
+        from hydrus_node import list_input_files
+
+        assert list_input_files(str(tmp_path / "missing")) == []
     
     @patch('hydrus_node.get_hydrus_client')
     def test_get_files_with_tag(self, mock_get_client, mock_hydrus_client):
@@ -116,10 +399,10 @@ class TestHydrusExport:
         hydrus_export = HydrusExport()
         hash_list = hydrus_export.get_files_with_tag("test_tag")
         
-        mock_hydrus_client.search_files.assert_called_once_with(["test_tag"])
-        mock_hydrus_client.get_file_metadata.assert_called_once_with(file_ids=[1, 2, 3])
+        mock_hydrus_client.search_files.assert_called_once_with(["test_tag"], return_hashes=True, return_file_ids=False)
+        mock_hydrus_client.get_file_metadata.assert_not_called()
         assert hash_list == ["test_hash_123"]
-    
+
     @patch('hydrus_node.get_hydrus_client')
     @patch('hydrus_node.get_hydrus_service_key')
     def test_get_file_metadata(self, mock_get_service_key, mock_get_client, mock_hydrus_client):
@@ -139,6 +422,34 @@ class TestHydrusExport:
         }
         assert metadata == expected
     
+    @patch('hydrus_node.get_hydrus_client')
+    @patch('hydrus_node.METADATA_CHUNK_SIZE', 2)
+    def test_get_files_metadata_bulk(self, mock_get_client, mock_hydrus_client):
+        """Test many hashes are fetched in chunks and parsed per file"""
+        mock_get_client.return_value = mock_hydrus_client
+        def get_file_metadata(hashes):
+            return {'metadata': [
+                {'hash': h, 'tags': {'test_service_key': {'display_tags': {'0': ['modelname:model_' + h]}}}}
+                for h in hashes
+            ]}
+        mock_hydrus_client.get_file_metadata.side_effect = get_file_metadata
+
+        hydrus_export = HydrusExport()
+        records = hydrus_export.get_files_metadata(['h1', 'h2', 'h3'])
+
+        assert mock_hydrus_client.get_file_metadata.call_count == 2
+        assert {h: r['modelname'] for h, r in records.items()} == {'h1': 'model_h1', 'h2': 'model_h2', 'h3': 'model_h3'}
+
+    @patch('hydrus_node.get_hydrus_client')
+    def test_get_files_metadata_no_tags(self, mock_get_client, mock_hydrus_client):
+        """Test a file without any tags on the service parses to an empty record"""
+        mock_get_client.return_value = mock_hydrus_client
+        mock_hydrus_client.get_file_metadata.return_value = {'metadata': [{'hash': 'h1', 'tags': {}}]}
+
+        hydrus_export = HydrusExport()
+
+        assert hydrus_export.get_files_metadata(['h1']) == {'h1': {'loras': []}}
+
     @patch('hydrus_node.get_hydrus_client')
     def test_get_file(self, mock_get_client, mock_hydrus_client):
         """Test getting file content"""
@@ -150,6 +461,457 @@ class TestHydrusExport:
         mock_hydrus_client.get_file.assert_called_once_with("test_hash")
         assert file_content == b'fake_image_data'
 
+    @patch('hydrus_node.get_hydrus_client')
+    def test_load_image_matches_old_conversion(self, mock_get_client, mock_hydrus_client):
+        """Test decoding gives the same floats as converting through numpy the old way"""
+        import io
+        mock_get_client.return_value = mock_hydrus_client
+        pixels = np.random.randint(0, 256, (8, 6, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, "PNG")
+        mock_hydrus_client.get_file.return_value = Mock(content=buffer.getvalue())
+
+        image = HydrusExport().load_image("test_hash")
+
+        expected = torch.from_numpy(pixels.astype(np.float32) / 255.0)[None,]
+        assert image.dtype == torch.float32
+        assert torch.equal(image, expected)
+
+    @patch('hydrus_node.get_hydrus_client')
+    def test_load_image_converts_to_rgb(self, mock_get_client, mock_hydrus_client):
+        """Test images that aren't RGB still come out with three channels"""
+        import io
+        mock_get_client.return_value = mock_hydrus_client
+        buffer = io.BytesIO()
+        Image.new("RGBA", (4, 4), (255, 0, 0, 128)).save(buffer, "PNG")
+        mock_hydrus_client.get_file.return_value = Mock(content=buffer.getvalue())
+
+        image = HydrusExport().load_image("test_hash")
+
+        assert image.shape == (1, 4, 4, 3)
+        assert image[0, 0, 0].tolist() == [1.0, 0.0, 0.0]
+
+    def make_export(self, mock_hydrus_client, models):
+        """HydrusExport with metadata, checkpoints and images faked out, models maps hash -> modelname"""
+        with patch('hydrus_node.get_hydrus_client', return_value=mock_hydrus_client):
+            hydrus_export = HydrusExport()
+        hydrus_export.cursors = {}
+        hydrus_export.get_files_with_tag = Mock(return_value=list(models))
+        hydrus_export.get_files_metadata = Mock(side_effect=lambda hashes: {hash: {
+            'modelname': models[hash], 'positive': 'pos ' + hash, 'negative': 'neg', 'seed': '1', 'loras': []
+        } for hash in hashes})
+        hydrus_export.checkpointer = Mock(side_effect=lambda name: ("model " + name, "clip", "vae"))
+        hydrus_export.open_file = Mock(side_effect=lambda hash: hash)
+        hydrus_export.decode_image = Mock(side_effect=lambda fp: torch.zeros(1, 8, 8, 3))
+        hydrus_export.prefetch = Mock()
+        return hydrus_export
+
+    @patch('hydrus_node.folder_paths.get_annotated_filepath')
+    def test_export_local_file_hash(self, mock_get_path, mock_hydrus_client, tmp_path):
+        """Test the default mode looks the input file up by its sha256"""
+        path = tmp_path / "image.png"
+        path.write_bytes(b"local image")
+        mock_get_path.return_value = str(path)
+        hydrus_export = self.make_export(mock_hydrus_client, {})
+        hydrus_export.prep_image = Mock(return_value=("image",))
+
+        hydrus_export.export_from_hydrus(images="image.png")
+
+        hydrus_export.prep_image.assert_called_once_with(hashlib.sha256(b"local image").hexdigest())
+
+    def test_export_tag_first_is_lazy(self, mock_hydrus_client):
+        """Test the default tag mode only prepares the first file"""
+        hydrus_export = self.make_export(mock_hydrus_client, {'h1': 'a', 'h2': 'b', 'h3': 'a'})
+
+        result = hydrus_export.export_from_hydrus(tag="tag", usetag=True)
+
+        assert result[4] == 'pos h1'
+        hydrus_export.open_file.assert_called_once_with('h1')
+        hydrus_export.checkpointer.assert_called_once()
+
+    def test_export_tag_next_walks_the_tag(self, mock_hydrus_client):
+        """Test next mode returns the following file each run and wraps around"""
+        hydrus_export = self.make_export(mock_hydrus_client, {'h1': 'a', 'h2': 'b'})
+
+        positives = [hydrus_export.export_from_hydrus(tag="tag", usetag=True, tag_mode="next")[4] for _ in range(3)]
+
+        assert positives == ['pos h1', 'pos h2', 'pos h1']
+        assert hydrus_export.open_file.call_count == 3
+        # Each run starts downloading the files after it
+        assert [c[0][0] for c in hydrus_export.prefetch.call_args_list] == [['h2'], [], ['h2']]
+
+    def test_export_tag_next_list_shrinks(self, mock_hydrus_client):
+        """Test a file losing the tag between runs doesn't make next mode skip the one after it"""
+        hydrus_export = self.make_export(mock_hydrus_client, {'a': 'm', 'b': 'm', 'c': 'm', 'd': 'm'})
+
+        first = hydrus_export.export_from_hydrus(tag="tag", usetag=True, tag_mode="next")[4]
+        # a got processed and lost the tag
+        hydrus_export.get_files_with_tag.return_value = ['b', 'c', 'd']
+        second = hydrus_export.export_from_hydrus(tag="tag", usetag=True, tag_mode="next")[4]
+        # A new file sorting before the cursor doesn't bring back one that's already been done
+        hydrus_export.get_files_with_tag.return_value = ['a2', 'b', 'c', 'd']
+        third = hydrus_export.export_from_hydrus(tag="tag", usetag=True, tag_mode="next")[4]
+
+        assert [first, second, third] == ['pos a', 'pos b', 'pos c']
+
+    def test_export_tag_batch_models_shrink(self, mock_hydrus_client):
+        """Test batch mode moves on to the model after the last one exported even when that one's gone"""
+        hydrus_export = self.make_export(mock_hydrus_client, {'h1': 'a', 'h2': 'b', 'h3': 'c'})
+
+        first = hydrus_export.export_from_hydrus(tag="tag", usetag=True, tag_mode="batch")[6]
+        hydrus_export.get_files_with_tag.return_value = ['h2', 'h3']
+        second = hydrus_export.export_from_hydrus(tag="tag", usetag=True, tag_mode="batch")[6]
+        hydrus_export.get_files_with_tag.return_value = ['h3']
+        third = hydrus_export.export_from_hydrus(tag="tag", usetag=True, tag_mode="batch")[6]
+
+        assert [first, second, third] == ['a', 'b', 'c']
+
+    def test_export_tag_batch_groups_by_model(self, mock_hydrus_client):
+        """Test batch mode stacks every image of one model and loads that model once"""
+        hydrus_export = self.make_export(mock_hydrus_client, {'h1': 'a', 'h2': 'b', 'h3': 'a'})
+
+        first = hydrus_export.export_from_hydrus(tag="tag", usetag=True, tag_mode="batch")
+        second = hydrus_export.export_from_hydrus(tag="tag", usetag=True, tag_mode="batch")
+
+        assert first[0].shape == (2, 8, 8, 3)
+        assert first[1] == "model a.safetensors"
+        assert first[6] == 'a'
+        assert second[0].shape == (1, 8, 8, 3)
+        assert second[6] == 'b'
+        assert hydrus_export.checkpointer.call_count == 2
+        assert sorted(c[0][0] for c in hydrus_export.open_file.call_args_list) == ['h1', 'h2', 'h3']
+
+    @patch('hydrus_node.prefetch_depth', 2)
+    def test_prefetch_images_bounded_window(self, mock_hydrus_client):
+        """Test downloads run ahead of decoding by at most the prefetch depth"""
+        import threading
+        hydrus_export = self.make_export(mock_hydrus_client, {})
+        started = []
+        release = {h: threading.Event() for h in ['h1', 'h2', 'h3', 'h4']}
+        def open_file(hash):
+            started.append(hash)
+            release[hash].wait(5)
+            return hash
+        hydrus_export.open_file = Mock(side_effect=open_file)
+        hydrus_export.decode_image = Mock(side_effect=lambda fp: fp)
+
+        images = hydrus_export.prefetch_images(['h1', 'h2', 'h3', 'h4'])
+        # Nothing has been consumed yet, but the first two downloads are already going
+        for _ in range(500):
+            if len(started) >= 2:
+                break
+            threading.Event().wait(0.01)
+        assert sorted(started) == ['h1', 'h2']
+        for event in release.values():
+            event.set()
+
+        assert list(images) == ['h1', 'h2', 'h3', 'h4']
+
+    @patch('hydrus_node.get_hydrus_client')
+    @patch('hydrus_node.prefetch_pool')
+    def test_prefetch_skips_cached_files(self, mock_pool, mock_get_client, mock_hydrus_client, isolated_file_cache):
+        """Test prefetching only downloads files that aren't cached yet"""
+        mock_get_client.return_value = mock_hydrus_client
+        data = b"cached"
+        cached_hash = hashlib.sha256(data).hexdigest()
+        isolated_file_cache.put(cached_hash, data)
+        hydrus_export = HydrusExport()
+
+        hydrus_export.prefetch([cached_hash, 'h2'])
+
+        submitted = [c[0] for c in mock_pool.submit.call_args_list]
+        assert (hydrus_export.get_files_metadata, [cached_hash, 'h2']) in submitted
+        assert (hydrus_export.prefetch_file, 'h2') in submitted
+        assert (hydrus_export.prefetch_file, cached_hash) not in submitted
+
+    def test_export_tag_without_files(self, mock_hydrus_client):
+        """Test a tag with no files gives a clear error"""
+        hydrus_export = self.make_export(mock_hydrus_client, {})
+
+        with pytest.raises(ValueError):
+            hydrus_export.export_from_hydrus(tag="tag", usetag=True)
+
+    def test_is_changed(self):
+        """Test cursor modes always re-run and the rest don't"""
+        assert HydrusExport.IS_CHANGED(tag="tag", usetag=True) == ""
+        result = HydrusExport.IS_CHANGED(tag="tag", usetag=True, tag_mode="next")
+        assert result != result
+
+    def test_stack_images_resizes(self):
+        """Test images of a different size are resized to the first one"""
+        from hydrus_node import stack_images
+
+        stacked = stack_images([torch.rand(1, 8, 8, 3), torch.rand(1, 16, 4, 3)])
+
+        assert stacked.shape == (2, 8, 8, 3)
+
+
+class TestFileCache:
+
+    def test_put_and_open(self, isolated_file_cache):
+        """Test a verified download can be read back through mmap"""
+        data = b"image bytes"
+        hash = hashlib.sha256(data).hexdigest()
+
+        assert isolated_file_cache.put(hash, data)
+
+        with isolated_file_cache.open(hash.upper()) as cached:
+            assert cached.read() == data
+
+    def test_rejects_wrong_hash(self, isolated_file_cache):
+        """Test bytes that don't match their hash aren't cached"""
+        hash = hashlib.sha256(b"expected").hexdigest()
+
+        assert not isolated_file_cache.put(hash, b"something else")
+        assert isolated_file_cache.open(hash) is None
+
+    def test_rejects_path_outside_cache(self, isolated_file_cache, tmp_path):
+        """Test a hash that isn't a sha256 never turns into a path"""
+        outside = tmp_path / "x"
+        outside.write_bytes(b"secret")
+
+        with pytest.raises(ValueError):
+            isolated_file_cache.path("../../x")
+        assert isolated_file_cache.open("../" * 10 + str(outside)) is None
+        assert not isolated_file_cache.contains("../../x")
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        """Test going over the size cap drops the file read longest ago"""
+        from hydrus_node import FileCache
+        cache = FileCache(str(tmp_path), 25)
+        blobs = [bytes([i]) * 10 for i in range(3)]
+        hashes = [hashlib.sha256(blob).hexdigest() for blob in blobs]
+
+        cache.put(hashes[0], blobs[0])
+        cache.put(hashes[1], blobs[1])
+        os.utime(cache.path(hashes[1]), (1, 1))
+        os.utime(cache.path(hashes[0]), (2, 2))
+        cache.put(hashes[2], blobs[2])
+
+        assert cache.open(hashes[1]) is None
+        assert cache.open(hashes[0]) is not None
+        assert cache.open(hashes[2]) is not None
+
+    @patch('hydrus_node.get_hydrus_client')
+    def test_export_reads_from_cache(self, mock_get_client, mock_hydrus_client):
+        """Test an image downloaded once is loaded from the cache after that"""
+        import io
+        mock_get_client.return_value = mock_hydrus_client
+        buffer = io.BytesIO()
+        Image.new("RGB", (4, 4), (0, 255, 0)).save(buffer, "PNG")
+        data = buffer.getvalue()
+        mock_hydrus_client.get_file.return_value = Mock(content=data)
+        hash = hashlib.sha256(data).hexdigest()
+
+        hydrus_export = HydrusExport()
+        first = hydrus_export.load_image(hash)
+        second = hydrus_export.load_image(hash)
+
+        assert torch.equal(first, second)
+        mock_hydrus_client.get_file.assert_called_once_with(hash)
+
+
+class TestGenerationIndex:
+
+    def test_record_and_lookup(self, isolated_generation_index):
+        """Test records come back the same way get_files_metadata shapes them"""
+        record = {'modelname': 'model', 'positive': 'a cat', 'seed': '1', 'loras': ['one']}
+        isolated_generation_index.record_many({'h1': (record, ['modelname:model', 'to upscale'])})
+
+        assert isolated_generation_index.lookup(['h1', 'h2']) == {'h1': record}
+        assert isolated_generation_index.hashes_for_tag('to upscale') == ['h1']
+
+    def test_sync_only_fetches_new_files(self, isolated_generation_index, mock_hydrus_client):
+        """Test an incremental sync only asks Hydrus about files the index hasn't seen"""
+        record = {'modelname': 'a', 'positive': 'p', 'negative': 'n', 'seed': '1', 'loras': []}
+        isolated_generation_index.record_many({'h1': (record, ['modelname:a'])})
+        mock_hydrus_client.search_files.return_value = {'hashes': ['h1', 'h2']}
+        mock_hydrus_client.get_file_metadata.return_value = {'metadata': [
+            {'hash': 'h2', 'tags': {'test_service_key': {'display_tags': {'0': ['modelname:b', 'done']}}}}
+        ]}
+
+        assert isolated_generation_index.sync(mock_hydrus_client) == 1
+
+        mock_hydrus_client.get_file_metadata.assert_called_once_with(hashes=['h2'])
+        assert isolated_generation_index.lookup(['h2'])['h2']['modelname'] == 'b'
+        assert isolated_generation_index.last_sync() > 0
+
+    def test_sync_drops_deleted_files(self, isolated_generation_index, mock_hydrus_client):
+        """Test files Hydrus no longer returns are dropped from the index"""
+        isolated_generation_index.record_many({
+            'h1': ({'modelname': 'a', 'loras': []}, ['modelname:a', 'keep']),
+            'gone': ({'modelname': 'a', 'loras': []}, ['modelname:a', 'keep']),
+        })
+        mock_hydrus_client.search_files.return_value = {'hashes': ['h1']}
+
+        isolated_generation_index.sync(mock_hydrus_client)
+
+        assert set(isolated_generation_index.lookup(['h1', 'gone'])) == {'h1'}
+        assert isolated_generation_index.hashes_for_tag('keep') == ['h1']
+
+    @patch('hydrus_node.hydrus_api.utils.verify_permissions')
+    def test_import_batch_fills_index(self, mock_verify_perms, mock_hydrus_client, isolated_generation_index):
+        """Test imported files land in the index with their generation tags"""
+        mock_verify_perms.return_value = True
+        hydrus_import = HydrusImport()
+        encoded = [hydrus_import.encode_image(np.zeros((8, 8, 3), dtype=np.uint8), compression="0")]
+
+        hydrus_import.import_batch(mock_hydrus_client, encoded, ['modelname: model', 'positive: a cat', ' ai'])
+
+        assert isolated_generation_index.lookup(['new_hash_456']) == {'new_hash_456': {'modelname': 'model', 'positive': 'a cat', 'loras': []}}
+        assert isolated_generation_index.hashes_for_tag('ai') == ['new_hash_456']
+
+    @patch('hydrus_node.hydrus_api.utils.verify_permissions')
+    def test_import_batch_indexes_tags_like_hydrus(self, mock_verify_perms, mock_hydrus_client, isolated_generation_index):
+        """Test tags typed on the node are indexed the way Hydrus spells them, and found either way"""
+        mock_verify_perms.return_value = True
+        hydrus_import = HydrusImport()
+        encoded = [hydrus_import.encode_image(np.zeros((8, 8, 3), dtype=np.uint8), compression="0")]
+
+        hydrus_import.import_batch(mock_hydrus_client, encoded, ['modelname: Model', 'hyshare: ai'])
+
+        assert isolated_generation_index.lookup(['new_hash_456'])['new_hash_456']['modelname'] == 'model'
+        assert isolated_generation_index.hashes_for_tag('hyshare:ai') == ['new_hash_456']
+        assert isolated_generation_index.hashes_for_tag(' Hyshare: AI') == ['new_hash_456']
+
+    @patch('hydrus_node.get_hydrus_client')
+    def test_export_metadata_uses_index(self, mock_get_client, mock_hydrus_client):
+        """Test metadata Hydrus was asked for once comes from the index after that"""
+        mock_get_client.return_value = mock_hydrus_client
+        hydrus_export = HydrusExport()
+
+        first = hydrus_export.get_files_metadata(['test_hash_123'])
+        second = hydrus_export.get_files_metadata(['test_hash_123'])
+
+        assert first == second
+        mock_hydrus_client.get_file_metadata.assert_called_once()
+
+    @patch('hydrus_node.get_hydrus_client')
+    def test_export_metadata_refetches_incomplete_rows(self, mock_get_client, mock_hydrus_client, isolated_generation_index):
+        """Test an index row missing what an export needs is fetched from Hydrus again and overwritten"""
+        mock_get_client.return_value = mock_hydrus_client
+        isolated_generation_index.record_many({'test_hash_123': ({'loras': []}, ['ai'])})
+        hydrus_export = HydrusExport()
+
+        records = hydrus_export.get_files_metadata(['test_hash_123'])
+
+        assert records['test_hash_123']['modelname'] == 'test_model'
+        mock_hydrus_client.get_file_metadata.assert_called_once()
+        assert isolated_generation_index.lookup(['test_hash_123'])['test_hash_123']['seed'] == '12345'
+
+    @patch('hydrus_node.get_hydrus_client')
+    def test_export_metadata_without_index(self, mock_get_client, mock_hydrus_client, tmp_path, monkeypatch):
+        """Test an index that can't be opened just means the metadata comes from Hydrus"""
+        import hydrus_node
+        mock_get_client.return_value = mock_hydrus_client
+        index = hydrus_node.GenerationIndex(str(tmp_path / "missing" / "hydrus_index.sqlite3"))
+        monkeypatch.setattr(hydrus_node, "generation_index", index)
+        hydrus_export = HydrusExport()
+
+        records = hydrus_export.get_files_metadata(['test_hash_123'])
+
+        assert records['test_hash_123']['modelname'] == 'test_model'
+        mock_hydrus_client.get_file_metadata.assert_called_once()
+        assert index.connection is None
+
+    @patch('hydrus_node.get_hydrus_client')
+    def test_export_tag_from_index(self, mock_get_client, mock_hydrus_client, isolated_generation_index):
+        """Test use_index takes the tag's files from one search and their metadata from the index"""
+        mock_get_client.return_value = mock_hydrus_client
+        isolated_generation_index.record_many({'h1': ({'modelname': 'a', 'positive': 'p', 'negative': 'n', 'seed': '1', 'loras': []}, ['modelname:a'])})
+        mock_hydrus_client.search_files.return_value = {'hashes': ['h1']}
+        isolated_generation_index.sync_if_due = Mock()
+        hydrus_export = HydrusExport()
+        hydrus_export.checkpointer = Mock(return_value=("model", "clip", "vae"))
+        hydrus_export.load_image = Mock(return_value=torch.zeros(1, 8, 8, 3))
+
+        result = hydrus_export.export_from_hydrus(tag="upscale me", usetag=True, use_index=True)
+
+        assert result[6] == 'a'
+        mock_hydrus_client.search_files.assert_called_once_with(["upscale me"], return_hashes=True, return_file_ids=False)
+        mock_hydrus_client.get_file_metadata.assert_not_called()
+        hydrus_export.load_image.assert_called_once_with('h1')
+
+    def test_refresh_tag_replaces_membership(self, isolated_generation_index, mock_hydrus_client):
+        """Test a tag added or removed in Hydrus after indexing shows up on the next lookup"""
+        isolated_generation_index.record_many({
+            'h1': ({'modelname': 'a', 'loras': []}, ['modelname:a', 'to upscale']),
+            'h2': ({'modelname': 'a', 'loras': []}, ['modelname:a']),
+        })
+        mock_hydrus_client.search_files.return_value = {'hashes': ['h2']}
+
+        assert isolated_generation_index.refresh_tag(mock_hydrus_client, 'To Upscale') == ['h2']
+        assert isolated_generation_index.hashes_for_tag('to upscale') == ['h2']
+        assert isolated_generation_index.hashes_for_tag('modelname:a') == ['h1', 'h2']
+
+
+class TestCheckpointCache:
+
+    def test_hit_and_miss_counters(self):
+        """Test a second lookup of the same checkpoint doesn't load it again"""
+        from hydrus_node import CheckpointCache
+        cache = CheckpointCache(budget_bytes=10)
+        loader = Mock(return_value=("model", "clip", "vae"))
+
+        assert cache.get("/models/a.safetensors", loader) == ("model", "clip", "vae")
+        assert cache.get("/models/a.safetensors", loader) == ("model", "clip", "vae")
+
+        loader.assert_called_once_with("/models/a.safetensors")
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        """Test going over the budget drops the oldest checkpoint but keeps the newest"""
+        from hydrus_node import CheckpointCache
+        paths = []
+        for name in ("a", "b", "c"):
+            path = tmp_path / "{}.safetensors".format(name)
+            path.write_bytes(b"x" * 100)
+            paths.append(str(path))
+        cache = CheckpointCache(budget_bytes=250)
+        loader = Mock(side_effect=lambda path: (path,))
+
+        cache.get(paths[0], loader)
+        cache.get(paths[1], loader)
+        cache.get(paths[0], loader)
+        cache.get(paths[2], loader)
+
+        assert list(cache.entries) == [paths[0], paths[2]]
+        assert cache.stats()["bytes"] == 200
+
+    def test_newest_kept_when_over_budget(self, tmp_path):
+        """Test a checkpoint bigger than the whole budget still gets cached on its own"""
+        from hydrus_node import CheckpointCache
+        path = tmp_path / "big.safetensors"
+        path.write_bytes(b"x" * 100)
+        cache = CheckpointCache(budget_bytes=10)
+        loader = Mock(return_value=("model",))
+
+        cache.get(str(path), loader)
+        cache.get(str(path), loader)
+
+        loader.assert_called_once()
+
+    @patch('hydrus_node.get_hydrus_client')
+    @patch('hydrus_node.checkpoint_cache')
+    def test_checkpointer_uses_cache(self, mock_cache, mock_get_client, mock_hydrus_client):
+        """Test checkpointer goes through the shared cache"""
+        mock_get_client.return_value = mock_hydrus_client
+        mock_cache.get.return_value = ("model", "clip", "vae")
+
+        hydrus_export = HydrusExport()
+        assert hydrus_export.checkpointer("test_model.safetensors") == ("model", "clip", "vae")
+        assert mock_cache.get.call_args[0][1] == hydrus_export.load_checkpoint
+
+    @patch('hydrus_node.get_hydrus_client')
+    @patch('hydrus_node.sd.load_checkpoint_guess_config')
+    def test_load_checkpoint_drops_last_output(self, mock_load, mock_get_client, mock_hydrus_client):
+        """Test only model, clip and vae come back from a load"""
+        mock_get_client.return_value = mock_hydrus_client
+        mock_load.return_value = ("model", "clip", "vae", "clipvision")
+
+        assert HydrusExport().load_checkpoint("/fake/checkpoint.safetensors") == ("model", "clip", "vae")
+
 
 class TestHydrusDuplicates:
     
@@ -166,6 +928,10 @@ class TestHydrusDuplicates:
     def test_dedupe(self, mock_sleep, mock_get_client, mock_hydrus_client):
         """Test deduplication functionality"""
         mock_get_client.return_value = mock_hydrus_client
+        mock_hydrus_client.get_file_metadata.return_value = {'metadata': [
+            {'hash': 'original_hash', 'file_id': 1},
+            {'hash': 'upscaled_hash', 'file_id': 2},
+        ]}
         mock_hydrus_client.set_file_relationships.return_value = {"success": True}
         
         hydrus_duplicates = HydrusDuplicates()
@@ -181,8 +947,68 @@ class TestHydrusDuplicates:
         ]
         
         mock_hydrus_client.set_file_relationships.assert_called_once_with(expected_body)
+        mock_sleep.assert_not_called()
         assert result == {"success": True}
 
+    @patch('hydrus_node.get_hydrus_client')
+    @patch('time.sleep')
+    def test_dedupe_batch_waits_for_files(self, mock_sleep, mock_get_client, mock_hydrus_client):
+        """Test several pairs go in one request once Hydrus has every file"""
+        mock_get_client.return_value = mock_hydrus_client
+        mock_hydrus_client.get_file_metadata.side_effect = [
+            {'metadata': [{'hash': h, 'file_id': None if h == 'up2' else 1} for h in ['orig1', 'orig2', 'up1', 'up2']]},
+            {'metadata': [{'hash': 'up2', 'file_id': 5}]},
+        ]
+
+        hydrus_duplicates = HydrusDuplicates()
+        hydrus_duplicates.dedupe("orig1\norig2", ["up1", "up2"])
+
+        assert mock_hydrus_client.get_file_metadata.call_count == 2
+        mock_sleep.assert_called_once()
+        body = mock_hydrus_client.set_file_relationships.call_args[0][0]
+        assert [(pair["hash_a"], pair["hash_b"]) for pair in body] == [("orig1", "up1"), ("orig2", "up2")]
+
+    @patch('hydrus_node.get_hydrus_client')
+    @patch('hydrus_node.dedupe_timeout', 0)
+    def test_dedupe_skips_missing_after_timeout(self, mock_get_client, mock_hydrus_client):
+        """Test pairs whose files never show up are left out"""
+        mock_get_client.return_value = mock_hydrus_client
+        mock_hydrus_client.get_file_metadata.return_value = {'metadata': [
+            {'hash': 'orig1', 'file_id': 1}, {'hash': 'up1', 'file_id': 2},
+            {'hash': 'orig2', 'file_id': 3}, {'hash': 'up2', 'file_id': None},
+        ]}
+
+        hydrus_duplicates = HydrusDuplicates()
+        hydrus_duplicates.dedupe("orig1, orig2", "up1, up2")
+
+        body = mock_hydrus_client.set_file_relationships.call_args[0][0]
+        assert [(pair["hash_a"], pair["hash_b"]) for pair in body] == [("orig1", "up1")]
+
+    @patch('hydrus_node.get_hydrus_client')
+    @patch('time.sleep')
+    def test_dedupe_uppercase_hashes(self, mock_sleep, mock_get_client, mock_hydrus_client):
+        """Test hashes pasted in upper case match Hydrus's lower case ones without waiting"""
+        mock_get_client.return_value = mock_hydrus_client
+        mock_hydrus_client.get_file_metadata.return_value = {'metadata': [
+            {'hash': 'abc1', 'file_id': 1}, {'hash': 'def2', 'file_id': 2},
+        ]}
+
+        HydrusDuplicates().dedupe("ABC1", "Def2")
+
+        mock_sleep.assert_not_called()
+        body = mock_hydrus_client.set_file_relationships.call_args[0][0]
+        assert [(pair["hash_a"], pair["hash_b"]) for pair in body] == [("abc1", "def2")]
+
+    @patch('hydrus_node.get_hydrus_client')
+    def test_dedupe_mismatched_lists(self, mock_get_client, mock_hydrus_client):
+        """Test uneven hash lists don't send anything"""
+        mock_get_client.return_value = mock_hydrus_client
+
+        result = HydrusDuplicates().dedupe("orig1 orig2", "up1")
+
+        assert result is None
+        mock_hydrus_client.set_file_relationships.assert_not_called()
+
 
 class TestNodeClassMappings:
     
@@ -196,4 +1022,134 @@ class TestNodeClassMappings:
         
         assert NODE_CLASS_MAPPINGS["Hydrus Image Importer"] == HydrusImport
         assert NODE_CLASS_MAPPINGS["Hydrus Image Exporter"] == HydrusExport
-        assert NODE_CLASS_MAPPINGS["Hydrus Image Dedupe"] == HydrusDuplicates
\ No newline at end of file
+        assert NODE_CLASS_MAPPINGS["Hydrus Image Dedupe"] == HydrusDuplicates
+
+class TestHydrusSpool:
+
+    def make_spool(self, tmp_path):
+        from hydrus_node import HydrusSpool
+        spool = HydrusSpool(str(tmp_path / "spool"))
+        spool.start = Mock()
+        return spool
+
+    def encoded(self, *values):
+        hydrus_import = HydrusImport()
+        return [hydrus_import.encode_image(np.full((8, 8, 3), value, dtype=np.uint8), compression="0") for value in values]
+
+    def test_put_writes_files_and_journal(self, tmp_path):
+        """Test spooled images are stored by hash and survive a restart"""
+        from hydrus_node import HydrusSpool
+        spool = self.make_spool(tmp_path)
+        encoded = self.encoded(0, 255)
+
+        spool.put(encoded, ["tag1"])
+
+        for imagefile, size in encoded:
+            path = tmp_path / "spool" / "files" / (imagefile.hexdigest() + ".png")
+            assert path.read_bytes() == imagefile.getvalue()
+        spool.start.assert_called_once()
+        # A fresh spool (after a restart) sees the same pending files
+        assert HydrusSpool(str(tmp_path / "spool")).depth() == 2
+
+    @patch('hydrus_node.get_hydrus_client')
+    def test_drain_imports_and_cleans_up(self, mock_get_client, tmp_path, mock_hydrus_client):
+        """Test replaying sends the files to Hydrus and clears the spool"""
+        mock_get_client.return_value = mock_hydrus_client
+        spool = self.make_spool(tmp_path)
+        encoded = self.encoded(0, 255)
+        spool.put(encoded, ["tag1"])
+
+        uploaded = {}
+        def import_batch(client, files, tags):
+            uploaded.update({f.hexdigest(): (f.reader().read(), tags) for f, size in files})
+            return []
+
+        with patch('hydrus_node.HydrusImport.import_batch', side_effect=import_batch):
+            assert spool.drain()
+
+        assert uploaded == {f.hexdigest(): (f.getvalue(), ["tag1"]) for f, size in encoded}
+        assert spool.depth() == 0
+        assert not os.listdir(tmp_path / "spool" / "files")
+        assert not (tmp_path / "spool" / "journal.jsonl").exists()
+
+    @patch('hydrus_node.get_hydrus_client')
+    def test_drain_failure_keeps_files(self, mock_get_client, tmp_path, mock_hydrus_client):
+        """Test files stay spooled when Hydrus can't be reached"""
+        import hydrus_api
+        mock_get_client.return_value = mock_hydrus_client
+        spool = self.make_spool(tmp_path)
+        spool.put(self.encoded(0), ["tag1"])
+
+        with patch('hydrus_node.HydrusImport.import_batch', side_effect=hydrus_api.ConnectionError(None)):
+            assert not spool.drain()
+
+        assert spool.depth() == 1
+
+    @patch('hydrus_node.get_hydrus_client')
+    def test_drain_keeps_refused_files(self, mock_get_client, tmp_path, mock_hydrus_client):
+        """Test a file Hydrus refuses is moved to failed/ with its tags instead of deleted"""
+        from hydrus_api import ImportStatus
+        mock_get_client.return_value = mock_hydrus_client
+        spool = self.make_spool(tmp_path)
+        encoded = self.encoded(0, 255)
+        spool.put(encoded, ["tag1"])
+        hashes = [f.hexdigest() for f, size in encoded]
+        statuses = {hashes[0]: ImportStatus.SUCCESS, hashes[1]: ImportStatus.FAILED}
+
+        def import_batch(client, files, tags):
+            return [{"status": statuses[f.hexdigest()], "hash": f.hexdigest(), "note": "broken"} for f, size in files]
+
+        with patch('hydrus_node.HydrusImport.import_batch', side_effect=import_batch):
+            assert spool.drain()
+
+        assert spool.depth() == 0
+        assert not os.listdir(tmp_path / "spool" / "files")
+        failed_dir = tmp_path / "spool" / "failed"
+        assert (failed_dir / (hashes[1] + ".png")).read_bytes() == encoded[1][0].getvalue()
+        assert json.loads((failed_dir / (hashes[1] + ".json")).read_text()) == {"tags": ["tag1"], "note": "broken"}
+        assert not (failed_dir / (hashes[0] + ".png")).exists()
+
+    def test_respool_during_replay_keeps_file(self, tmp_path):
+        """Test an image spooled again while its older entry replays stays pending with its file"""
+        spool = self.make_spool(tmp_path)
+        spool.put(self.encoded(0), ["tag1"])
+        replaying = spool.pending_batches()[0]
+
+        spool.put(self.encoded(0), ["tag2"])
+        spool.mark_done(replaying)
+
+        assert spool.depth() == 1
+        assert len(os.listdir(tmp_path / "spool" / "files")) == 1
+
+    def test_torn_journal_line_ignored(self, tmp_path):
+        """Test a half written journal line from a crash doesn't break loading"""
+        from hydrus_node import HydrusSpool
+        spool = self.make_spool(tmp_path)
+        spool.put(self.encoded(0), ["tag1"])
+        with open(spool.journal_path, "a") as f:
+            f.write('{"op": "add", "hash": "abc')
+
+        assert HydrusSpool(str(tmp_path / "spool")).depth() == 1
+
+    def test_respool_merges_tags(self, tmp_path):
+        """Test spooling the same image twice keeps one entry with both sets of tags"""
+        spool = self.make_spool(tmp_path)
+        spool.put(self.encoded(0), ["tag1"])
+        spool.put(self.encoded(0), ["tag1", "tag2"])
+
+        batches = spool.pending_batches()
+        assert len(batches) == 1
+        assert batches[0][0]["tags"] == ["tag1", "tag2"]
+
+    @patch('hydrus_node.get_hydrus_client')
+    @patch('hydrus_node.import_spool')
+    def test_import_to_hydrus_spool(self, mock_spool, mock_get_client, mock_hydrus_client, sample_image_tensor):
+        """Test spool mode hands the batch to the spool instead of Hydrus"""
+        mock_get_client.return_value = mock_hydrus_client
+
+        hydrus_import = HydrusImport()
+        hydrus_import.import_batch = Mock()
+        hydrus_import.import_to_hydrus(sample_image_tensor, tags="ai", spool=True, file_format="WEBP")
+
+        assert mock_spool.put.call_args[0][1:] == (["ai"], ".webp")
+        hydrus_import.import_batch.assert_not_called()
@@ -5,23 +5,11 @@ import sys
 from unittest.mock import Mock, patch, mock_open
 import responses
 
+from submit import (get_files_with_tag, queue_prompt, get_queue_depth, make_session, with_hash,
+                    load_checkpoint, Checkpoint, submit_all, parse_args, get_models, get_models_from_index,
+                    order_by_model, ComfyHost, pick_host)
 
-def get_files_with_tag(tag, client):
-    """Copy of function from submit.py for testing"""
-    hash_list = []
-    file_ids = client.search_files([tag])['file_ids']
-    files_metadata = client.get_file_metadata(file_ids=file_ids)['metadata']
-    for individual_file in files_metadata:
-        hash_list.append(individual_file['hash'])
-    return hash_list
-
-def queue_prompt(prompt):
-    """Copy of function from submit.py for testing"""
-    import requests
-    p = {"prompt": prompt}
-    data = json.dumps(p).encode('utf-8')
-    resp = requests.post("http://10.0.0.4:8188/prompt", data=data)
-    print(resp.text)
+HOST = "http://10.0.0.4:8188"
 
 
 class TestSubmitScript:
@@ -29,26 +17,18 @@ class TestSubmitScript:
     def test_get_files_with_tag(self):
         """Test getting files with specific tag from Hydrus"""
         mock_client = Mock()
-        mock_client.search_files.return_value = {'file_ids': [1, 2, 3]}
-        mock_client.get_file_metadata.return_value = {
-            'metadata': [
-                {'hash': 'hash1'},
-                {'hash': 'hash2'},
-                {'hash': 'hash3'}
-            ]
-        }
+        mock_client.search_files.return_value = {'hashes': ['hash1', 'hash2', 'hash3']}
         
         result = get_files_with_tag("test_tag", mock_client)
         
-        mock_client.search_files.assert_called_once_with(["test_tag"])
-        mock_client.get_file_metadata.assert_called_once_with(file_ids=[1, 2, 3])
+        mock_client.search_files.assert_called_once_with(["test_tag"], return_hashes=True, return_file_ids=False)
+        mock_client.get_file_metadata.assert_not_called()
         assert result == ['hash1', 'hash2', 'hash3']
     
     def test_get_files_with_tag_empty_result(self):
         """Test getting files when no files have the tag"""
         mock_client = Mock()
-        mock_client.search_files.return_value = {'file_ids': []}
-        mock_client.get_file_metadata.return_value = {'metadata': []}
+        mock_client.search_files.return_value = {'hashes': []}
         
         result = get_files_with_tag("nonexistent_tag", mock_client)
         
@@ -57,71 +37,414 @@ class TestSubmitScript:
     @responses.activate
     def test_queue_prompt_success(self):
         """Test successful prompt queuing to ComfyUI"""
-        # Mock the ComfyUI API response
-        responses.add(
-            responses.POST,
-            "http://10.0.0.4:8188/prompt",
-            json={"prompt_id": "test_prompt_id"},
-            status=200
-        )
-        
+        responses.add(responses.POST, HOST + "/prompt", json={"prompt_id": "test_prompt_id"}, status=200)
+
         test_prompt = {"test": "prompt_data"}
-        
-        # Capture print output
-        with patch('builtins.print') as mock_print:
-            queue_prompt(test_prompt)
-        
-        # Verify the request was made
+        result = queue_prompt(make_session(1), HOST, test_prompt)
+
         assert len(responses.calls) == 1
         request_data = json.loads(responses.calls[0].request.body)
         assert request_data == {"prompt": test_prompt}
-        
-        # Verify print was called with response
-        mock_print.assert_called_once()
-    
+        assert result == {"prompt_id": "test_prompt_id"}
+
     @responses.activate
     def test_queue_prompt_error(self):
         """Test prompt queuing with API error"""
-        # Mock an error response
-        responses.add(
-            responses.POST,
-            "http://10.0.0.4:8188/prompt",
-            json={"error": "Invalid prompt"},
-            status=400
-        )
-        
-        test_prompt = {"invalid": "prompt"}
-        
-        with patch('builtins.print') as mock_print:
-            queue_prompt(test_prompt)
-        
-        # Verify the request was made
+        import requests
+        responses.add(responses.POST, HOST + "/prompt", json={"error": "Invalid prompt"}, status=400)
+
+        with pytest.raises(requests.HTTPError):
+            queue_prompt(make_session(1), HOST, {"invalid": "prompt"})
+
         assert len(responses.calls) == 1
-        mock_print.assert_called_once()
 
+    @responses.activate
+    def test_get_queue_depth(self):
+        """Test queue depth counts running and pending prompts"""
+        responses.add(responses.GET, HOST + "/queue", json={"queue_running": [[0]], "queue_pending": [[1], [2]]})
 
-class TestSubmitScriptIntegration:
-    
-    @patch('test_submit.queue_prompt')
-    @patch('test_submit.get_files_with_tag')
-    @patch('builtins.open', mock_open(read_data='{"59": {"inputs": {}}}'))
-    def test_script_execution_flow(self, mock_get_files, mock_queue_prompt):
-        """Test the main script execution flow"""
-        # Mock client and file retrieval
+        assert get_queue_depth(make_session(1), HOST) == 3
+
+    def test_with_hash_leaves_prompt_alone(self):
+        """Test each job gets its own copy of the export node's inputs"""
+        prompt = {"59": {"inputs": {"hash": "", "usehash": True}}, "1": {"inputs": {}}}
+
+        job = with_hash(prompt, "59", "hash1")
+
+        assert job["59"]["inputs"] == {"hash": "hash1", "usehash": True}
+        assert prompt["59"]["inputs"]["hash"] == ""
+
+    def test_checkpoint_round_trip(self, tmp_path):
+        """Test queued hashes are written out and read back for resuming"""
+        path = str(tmp_path / "submitted.txt")
+        assert load_checkpoint(path) == set()
+
+        checkpoint = Checkpoint(path)
+        checkpoint.add("hash1")
+        checkpoint.add("hash2")
+
+        assert load_checkpoint(path) == {"hash1", "hash2"}
+
+    def test_parse_args_defaults(self):
+        """Test the defaults match what the script used to hard-code"""
+        args = parse_args(["--host", HOST + "/"])
+
+        assert args.tag == "tobeupscaledbeta"
+        assert args.node == "59"
+        assert args.hosts == [HOST]
+        assert args.checkpoint == "submitted-tobeupscaledbeta.txt"
+
+
+class TestSubmitAll:
+
+    PROMPT = {"59": {"inputs": {}}}
+
+    @responses.activate
+    def test_submits_everything_and_checkpoints(self, tmp_path):
+        """Test every hash is queued once and recorded"""
+        responses.add(responses.GET, HOST + "/queue", json={"queue_running": [], "queue_pending": []})
+        responses.add(responses.POST, HOST + "/prompt", json={"prompt_id": "id"})
+        path = str(tmp_path / "submitted.txt")
+
+        with patch('builtins.print'):
+            result = submit_all(make_session(2), [HOST], self.PROMPT, "59", ['hash1', 'hash2', 'hash3'], Checkpoint(path),
+                                concurrency=2, watermark=8)
+
+        assert result == (3, 0, 0)
+        posted = [json.loads(c.request.body)["prompt"]["59"]["inputs"]["hash"]
+                  for c in responses.calls if c.request.method == "POST"]
+        assert sorted(posted) == ['hash1', 'hash2', 'hash3']
+        assert load_checkpoint(path) == {'hash1', 'hash2', 'hash3'}
+
+    @responses.activate
+    def test_waits_for_queue_below_watermark(self, tmp_path):
+        """Test nothing is posted while ComfyUI's queue is at the watermark, and only the gap is filled after"""
+        responses.add(responses.GET, HOST + "/queue", json={"queue_running": [[0]], "queue_pending": [[1]]})
+        responses.add(responses.GET, HOST + "/queue", json={"queue_running": [[0]], "queue_pending": []})
+        responses.add(responses.GET, HOST + "/queue", json={"queue_running": [], "queue_pending": []})
+        responses.add(responses.POST, HOST + "/prompt", json={"prompt_id": "id"})
+
+        # A clock that only moves when submit sleeps, so every poll happens at a known point
+        clock = [0.0]
+        fake_time = Mock()
+        fake_time.monotonic.side_effect = lambda: clock[0]
+        fake_time.sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+
+        with patch('builtins.print'), patch('submit.time', fake_time):
+            result = submit_all(make_session(1), [HOST], self.PROMPT, "59", ['hash1', 'hash2', 'hash3'],
+                                Checkpoint(str(tmp_path / "submitted.txt")), concurrency=1, watermark=2)
+
+        assert result == (3, 0, 0)
+        fake_time.sleep.assert_called_once()
+        methods = [c.request.method for c in responses.calls]
+        assert methods == ["GET", "GET", "POST", "GET", "POST", "POST"]
+
+    @responses.activate
+    def test_failed_post_frees_its_place(self, tmp_path):
+        """Test a failed post gives its place in the queue back without waiting for the next poll"""
+        responses.add(responses.GET, HOST + "/queue", json={"queue_running": [], "queue_pending": []})
+        responses.add(responses.POST, HOST + "/prompt", json={"error": "bad"}, status=400)
+        responses.add(responses.POST, HOST + "/prompt", json={"prompt_id": "id"})
+
+        with patch('builtins.print'):
+            result = submit_all(make_session(1), [HOST], self.PROMPT, "59", ['h1', 'h2', 'h3'],
+                                Checkpoint(None), concurrency=1, watermark=2)
+
+        assert result == (2, 1, 0)
+        assert [c.request.method for c in responses.calls] == ["GET", "POST", "POST", "POST"]
+
+    @responses.activate
+    def test_failed_posts_are_not_checkpointed(self, tmp_path):
+        """Test a rejected prompt is left out of the checkpoint so a rerun tries it again"""
+        responses.add(responses.GET, HOST + "/queue", json={"queue_running": [], "queue_pending": []})
+        responses.add(responses.POST, HOST + "/prompt", json={"error": "bad"}, status=400)
+        responses.add(responses.POST, HOST + "/prompt", json={"prompt_id": "id"})
+        path = str(tmp_path / "submitted.txt")
+
+        with patch('builtins.print'):
+            result = submit_all(make_session(1), [HOST], self.PROMPT, "59", ['hash1', 'hash2'], Checkpoint(path),
+                                concurrency=1, watermark=8)
+
+        assert result == (1, 1, 0)
+        assert load_checkpoint(path) == {'hash2'}
+
+    @responses.activate
+    def test_accepted_post_without_json_is_checkpointed(self, tmp_path):
+        """Test a post ComfyUI accepted counts as queued even when the body isn't JSON"""
+        responses.add(responses.GET, HOST + "/queue", json={"queue_running": [], "queue_pending": []})
+        responses.add(responses.POST, HOST + "/prompt", body="queued", status=200)
+        path = str(tmp_path / "submitted.txt")
+
+        with patch('builtins.print'):
+            result = submit_all(make_session(1), [HOST], self.PROMPT, "59", ['hash1'], Checkpoint(path),
+                                concurrency=1, watermark=8)
+
+        assert result == (1, 0, 0)
+        assert load_checkpoint(path) == {'hash1'}
+
+
+class TestMultipleHosts:
+
+    PROMPT = {"59": {"inputs": {}}}
+    OTHER = "http://10.0.0.5:8188"
+
+    def test_pick_host_lowest_depth(self):
+        """Test jobs go to the host with the shortest queue"""
+        busy, idle = ComfyHost(HOST), ComfyHost(self.OTHER)
+        busy.depth, idle.depth = 5, 1
+
+        assert pick_host([busy, idle], None, watermark=8, concurrency=4) is idle
+
+    def test_pick_host_prefers_loaded_model(self):
+        """Test a host that last ran the same checkpoint wins over a shorter queue, as long as it has room"""
+        busy, idle = ComfyHost(HOST), ComfyHost(self.OTHER)
+        busy.depth, idle.depth = 5, 1
+        busy.last_model = 'a'
+
+        assert pick_host([busy, idle], 'a', watermark=8, concurrency=4) is busy
+        assert pick_host([busy, idle], 'b', watermark=8, concurrency=4) is idle
+        busy.depth = 8
+        assert pick_host([busy, idle], 'a', watermark=8, concurrency=4) is idle
+
+    def test_pick_host_skips_unhealthy_and_capped(self):
+        """Test dead hosts and hosts at their concurrency cap get nothing"""
+        dead, capped = ComfyHost(HOST), ComfyHost(self.OTHER)
+        dead.healthy = False
+        capped.in_flight = 2
+
+        assert pick_host([dead, capped], None, watermark=8, concurrency=2) is None
+
+    @responses.activate
+    def test_spreads_jobs_and_models(self, tmp_path):
+        """Test jobs spread over hosts and each model sticks to the host it started on"""
+        for host in (HOST, self.OTHER):
+            responses.add(responses.GET, host + "/queue", json={"queue_running": [], "queue_pending": []})
+            responses.add(responses.POST, host + "/prompt", json={"prompt_id": "id"})
+        models = {'h1': 'a', 'h2': 'a', 'h3': 'b', 'h4': 'b'}
+
+        with patch('builtins.print'):
+            result = submit_all(make_session(2, 2), [HOST, self.OTHER], self.PROMPT, "59", ['h1', 'h2', 'h3', 'h4'],
+                                Checkpoint(None), models, concurrency=2, watermark=8)
+
+        assert result == (4, 0, 0)
+        sent = {}
+        for c in responses.calls:
+            if c.request.method == "POST":
+                sent.setdefault(c.request.url.rsplit("/", 1)[0], []).append(
+                    json.loads(c.request.body)["prompt"]["59"]["inputs"]["hash"])
+        assert sorted(sorted(hashes) for hashes in sent.values()) == [['h1', 'h2'], ['h3', 'h4']]
+
+    @responses.activate
+    def test_dead_host_is_drained(self, tmp_path):
+        """Test a host that stops answering gets no more jobs and its job moves to a live host"""
+        import requests
+        responses.add(responses.GET, HOST + "/queue", json={"queue_running": [], "queue_pending": []})
+        responses.add(responses.GET, HOST + "/queue", body=requests.ConnectionError("down"))
+        responses.add(responses.POST, HOST + "/prompt", body=requests.ConnectionError("down"))
+        responses.add(responses.GET, self.OTHER + "/queue", json={"queue_running": [[0]], "queue_pending": []})
+        responses.add(responses.POST, self.OTHER + "/prompt", json={"prompt_id": "id"})
+        path = str(tmp_path / "submitted.txt")
+
+        with patch('builtins.print'):
+            result = submit_all(make_session(1, 2), [HOST, self.OTHER], self.PROMPT, "59", ['h1', 'h2'], Checkpoint(path),
+                                concurrency=1, watermark=8, poll_interval=0)
+
+        assert result == (2, 0, 0)
+        assert load_checkpoint(path) == {'h1', 'h2'}
+        dead_posts = [c for c in responses.calls if c.request.method == "POST" and c.request.url.startswith(HOST)]
+        assert len(dead_posts) == 1
+
+    @responses.activate
+    def test_read_timeout_is_not_sent_again(self, tmp_path):
+        """Test a post that timed out waiting for an answer isn't queued on another host, it may already be queued"""
+        import requests
+        responses.add(responses.GET, HOST + "/queue", json={"queue_running": [], "queue_pending": []})
+        responses.add(responses.POST, HOST + "/prompt", body=requests.ReadTimeout("slow"))
+        responses.add(responses.GET, self.OTHER + "/queue", json={"queue_running": [[0]], "queue_pending": []})
+        responses.add(responses.POST, self.OTHER + "/prompt", json={"prompt_id": "id"})
+        path = str(tmp_path / "submitted.txt")
+
+        with patch('builtins.print'):
+            result = submit_all(make_session(1, 2), [HOST, self.OTHER], self.PROMPT, "59", ['h1'], Checkpoint(path),
+                                concurrency=1, watermark=8, poll_interval=0)
+
+        assert result == (0, 1, 0)
+        assert [c.request.url for c in responses.calls if c.request.method == "POST"] == [HOST + "/prompt"]
+        assert load_checkpoint(path) == set()
+
+    @responses.activate
+    def test_gives_up_when_every_host_is_down(self, tmp_path):
+        """Test the jobs left are given up on, not checkpointed, once no host has answered for max_wait"""
+        import requests
+        responses.add(responses.GET, HOST + "/queue", body=requests.ConnectionError("down"))
+        responses.add(responses.GET, self.OTHER + "/queue", body=requests.ConnectionError("down"))
+        path = str(tmp_path / "submitted.txt")
+        clock = [0.0]
+        fake_time = Mock()
+        fake_time.monotonic.side_effect = lambda: clock[0]
+        fake_time.sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+
+        with patch('builtins.print'), patch('submit.time', fake_time):
+            result = submit_all(make_session(1, 2), [HOST, self.OTHER], self.PROMPT, "59", ['h1', 'h2'], Checkpoint(path),
+                                concurrency=1, watermark=8, poll_interval=2.0, max_wait=10.0)
+
+        assert result == (0, 0, 2)
+        assert clock[0] == 10.0
+        assert not [c for c in responses.calls if c.request.method == "POST"]
+        assert load_checkpoint(path) == set()
+
+    @patch.dict(os.environ, {"COMFYUI_URL": "http://a:8188/, http://b:8188"})
+    def test_hosts_from_environment(self):
+        """Test several hosts can come from COMFYUI_URL"""
+        assert parse_args([]).hosts == ["http://a:8188", "http://b:8188"]
+
+    def test_hosts_from_arguments(self):
+        """Test --host can be given more than once"""
+        assert parse_args(["--host", "http://a:8188", "--host", "http://b:8188"]).hosts == ["http://a:8188", "http://b:8188"]
+
+
+class TestModelOrdering:
+
+    def test_order_by_model_groups_checkpoints(self):
+        """Test jobs with the same model end up back to back, in the order models first show up"""
+        models = {'h1': 'a', 'h2': 'b', 'h3': 'a', 'h4': None, 'h5': 'b'}
+
+        result = order_by_model(['h1', 'h2', 'h3', 'h4', 'h5'], models)
+
+        assert result == ['h1', 'h3', 'h2', 'h5', 'h4']
+
+    def test_order_by_model_max_consecutive(self):
+        """Test the fairness cap lets models take turns"""
+        models = {'h1': 'a', 'h2': 'a', 'h3': 'a', 'h4': 'b', 'h5': 'a'}
+
+        result = order_by_model(['h1', 'h2', 'h3', 'h4', 'h5'], models, max_consecutive=2)
+
+        assert result == ['h1', 'h2', 'h4', 'h3', 'h5']
+
+    @patch('submit.METADATA_CHUNK_SIZE', 2)
+    def test_get_models_in_chunks(self):
+        """Test models are read from metadata a chunk at a time"""
+        def metadata(hashes):
+            return {'metadata': [{'hash': h, 'tags': {'service': {'display_tags': {'0': ['modelname: m_' + h, 'seed:1']}}}}
+                                 for h in hashes]}
+        mock_client = Mock()
+        mock_client.get_file_metadata.side_effect = metadata
+
+        result = get_models(mock_client, ['h1', 'h2', 'h3'])
+
+        assert result == {'h1': 'm_h1', 'h2': 'm_h2', 'h3': 'm_h3'}
+        assert mock_client.get_file_metadata.call_count == 2
+
+    def test_get_models_without_model_tag(self):
+        """Test files without a modelname tag come back as None"""
         mock_client = Mock()
+        mock_client.get_file_metadata.return_value = {'metadata': [{'hash': 'h1', 'tags': {}}]}
+
+        assert get_models(mock_client, ['h1']) == {'h1': None}
+
+    def test_get_models_from_index(self, isolated_generation_index):
+        """Test models can come from the node's local index"""
+        isolated_generation_index.record_many({
+            'hash1': ({'modelname': 'a', 'loras': []}, ['modelname:a']),
+            'hash2': ({'modelname': 'b', 'loras': []}, ['modelname:b']),
+        })
+
+        result = get_models_from_index(['hash1', 'hash2', 'hash3'], isolated_generation_index.path)
+
+        assert result == {'hash1': 'a', 'hash2': 'b'}
+
+    def test_get_models_from_missing_index(self, tmp_path):
+        """Test a missing index reads as empty and isn't created"""
+        path = tmp_path / "hydrus_index.sqlite3"
+
+        with patch('builtins.print'):
+            assert get_models_from_index(['hash1'], str(path)) == {}
+        assert not path.exists()
+
+
+class TestSubmitScriptIntegration:
+
+    @patch('submit.submit_all')
+    @patch('submit.get_files_with_tag')
+    @patch('submit.hydrus_api.Client')
+    def test_main_skips_checkpointed_hashes(self, mock_client, mock_get_files, mock_submit_all, tmp_path):
+        """Test the main flow reads the workflow and only queues hashes not in the checkpoint"""
+        from submit import main
+        workflow = tmp_path / "workflow.json"
+        workflow.write_text('{"59": {"inputs": {}}}')
+        checkpoint = tmp_path / "submitted.txt"
+        checkpoint.write_text("hash1\n")
         mock_get_files.return_value = ['hash1', 'hash2']
-        
-        # Simulate the main script logic
-        with open("upscale_workflow.json", "r") as file:
-            prompt = json.loads(file.read())
-        
-        tag = "tobeupscaledbeta" 
-        hash_list = mock_get_files(tag, mock_client)
-        
-        for i in hash_list:
-            prompt['59']['inputs']['hash'] = i
-            mock_queue_prompt(prompt)
-        
-        # Verify the calls
-        assert mock_queue_prompt.call_count == 2  # Called for each hash
-        mock_get_files.assert_called_once_with("tobeupscaledbeta", mock_client)
\ No newline at end of file
+        mock_client.return_value.get_file_metadata.return_value = {'metadata': [{'hash': 'hash2', 'tags': {}}]}
+        mock_submit_all.return_value = (1, 0, 0)
+
+        with patch('builtins.print'):
+            main(["--workflow", str(workflow), "--checkpoint", str(checkpoint), "--host", HOST])
+
+        mock_get_files.assert_called_once_with("tobeupscaledbeta", mock_client.return_value)
+        args = mock_submit_all.call_args[0]
+        assert args[1] == [HOST]
+        assert args[2] == {"59": {"inputs": {}}}
+        assert args[4] == ['hash2']
+
+    @patch('submit.submit_all')
+    @patch('submit.get_files_with_tag')
+    @patch('submit.hydrus_api.Client')
+    def test_main_exits_with_error_when_jobs_are_given_up(self, mock_client, mock_get_files, mock_submit_all, tmp_path):
+        """Test a run that gave up on jobs because every host was down doesn't look like it finished"""
+        from submit import main
+        workflow = tmp_path / "workflow.json"
+        workflow.write_text('{"59": {"inputs": {}}}')
+        mock_get_files.return_value = ['hash1', 'hash2']
+        mock_submit_all.return_value = (1, 0, 1)
+
+        with patch('builtins.print'), pytest.raises(SystemExit) as exit:
+            main(["--workflow", str(workflow), "--checkpoint", str(tmp_path / "submitted.txt"), "--host", HOST,
+                  "--no-group-by-model", "--max-wait", "5"])
+
+        assert exit.value.code == 1
+        assert mock_submit_all.call_args[0][10] == 5.0
+
+    @patch('submit.submit_all')
+    @patch('submit.get_files_with_tag')
+    @patch('submit.get_models')
+    @patch('submit.hydrus_api.Client')
+    def test_main_groups_by_model(self, mock_client, mock_get_models, mock_get_files, mock_submit_all, tmp_path):
+        """Test the main flow queues jobs grouped by checkpoint"""
+        from submit import main
+        workflow = tmp_path / "workflow.json"
+        workflow.write_text('{"59": {"inputs": {}}}')
+        mock_get_files.return_value = ['hash1', 'hash2', 'hash3']
+        mock_get_models.return_value = {'hash1': 'a', 'hash2': 'b', 'hash3': 'a'}
+        mock_submit_all.return_value = (3, 0, 0)
+
+        with patch('builtins.print'):
+            main(["--workflow", str(workflow), "--checkpoint", str(tmp_path / "submitted.txt")])
+
+        mock_get_models.assert_called_once_with(mock_client.return_value, ['hash1', 'hash2', 'hash3'])
+        assert mock_submit_all.call_args[0][4] == ['hash1', 'hash3', 'hash2']
+
+    @patch('submit.submit_all')
+    @patch('submit.get_files_with_tag')
+    @patch('submit.get_models')
+    @patch('submit.get_models_from_index')
+    @patch('submit.hydrus_api.Client')
+    def test_main_use_index_still_searches_hydrus(self, mock_client, mock_get_models, mock_get_hydrus_models, mock_get_files,
+                                                  mock_submit_all, tmp_path):
+        """Test --use-index only reads models from the index, the tag's files still come from Hydrus"""
+        from submit import main
+        workflow = tmp_path / "workflow.json"
+        workflow.write_text('{"59": {"inputs": {}}}')
+        mock_get_files.return_value = ['hash1', 'hash2']
+        mock_get_models.return_value = {'hash1': 'a', 'hash2': None}
+        mock_get_hydrus_models.return_value = {'hash2': 'b'}
+        mock_submit_all.return_value = (2, 0, 0)
+
+        with patch('builtins.print'):
+            main(["--workflow", str(workflow), "--checkpoint", str(tmp_path / "submitted.txt"), "--use-index"])
+
+        mock_get_files.assert_called_once_with("tobeupscaledbeta", mock_client.return_value)
+        mock_get_models.assert_called_once()
+        # Only the file the index has no model for is asked of Hydrus
+        mock_get_hydrus_models.assert_called_once_with(mock_client.return_value, ['hash2'])
+        assert mock_submit_all.call_args[0][6] == {'hash1': 'a', 'hash2': 'b'}
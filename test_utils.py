@@ -85,7 +85,7 @@ class TestUtilityFunctions:
                             
                             mock_client_class.return_value = "mocked_client"
                             client = get_hydrus_client()
-                            mock_client_class.assert_called_with("file_api_key", "http://localhost:45870")
+                            mock_client_class.assert_called_with("file_api_key", "http://localhost:45870", session=hydrus_node.session_pool)
     
     def test_get_hydrus_client_file_error(self, monkeypatch, capsys):
         """Test handling file read error"""
@@ -101,4 +101,284 @@ class TestUtilityFunctions:
                     client = get_hydrus_client()
                     
                     captured = capsys.readouterr()
-                    assert "API Key is required" in captured.out
\ No newline at end of file
+                    assert "API Key is required" in captured.out
+
+class TestImagesToUint8:
+
+    def test_matches_per_image_conversion(self):
+        """Test the batched conversion gives the same pixels as the old per-image numpy path"""
+        from hydrus_node import images_to_uint8
+        import numpy as np
+        import torch
+
+        images = torch.rand(3, 8, 8, 3) * 1.2 - 0.1
+        expected = np.stack([np.clip(255. * image.numpy(), 0, 255).astype(np.uint8) for image in images])
+
+        result = images_to_uint8(images)
+
+        assert result.dtype == np.uint8
+        assert result.shape == (3, 8, 8, 3)
+        np.testing.assert_array_equal(result, expected)
+
+    def test_does_not_modify_input(self):
+        """Test the input batch is left alone"""
+        from hydrus_node import images_to_uint8
+        import torch
+
+        images = torch.rand(1, 4, 4, 3)
+        original = images.clone()
+
+        images_to_uint8(images)
+
+        assert torch.equal(images, original)
+
+
+class TestCompressionTuner:
+
+    def test_default_level_without_upload_numbers(self):
+        """Test the tuner falls back to the default level until it has seen an upload"""
+        from hydrus_node import CompressionTuner
+        tuner = CompressionTuner()
+
+        assert tuner.choose() == CompressionTuner.DEFAULT_LEVEL
+
+    def test_tries_each_candidate_once(self):
+        """Test every candidate level is measured before picking one"""
+        from hydrus_node import CompressionTuner
+        tuner = CompressionTuner()
+        tuner.record_upload(1000, 1.0)
+
+        tried = []
+        for _ in CompressionTuner.CANDIDATES:
+            level = tuner.choose()
+            tried.append(level)
+            tuner.record_encode("PNG", level, 1000, 500, 0.1)
+
+        assert tried == list(CompressionTuner.CANDIDATES)
+
+    def test_slow_upload_prefers_smaller_files(self):
+        """Test a slow upload picks the level that saves the most bytes, a fast one the quickest encode"""
+        from hydrus_node import CompressionTuner
+        tuner = CompressionTuner(smoothing=1.0)
+        # Level 1 is fast and big, level 9 slow and small
+        for level, seconds, encoded in ((1, 0.01, 900), (3, 0.05, 800), (6, 0.2, 600), (9, 1.0, 500)):
+            tuner.record_encode("PNG", level, 1000, encoded, seconds)
+
+        tuner.record_upload(1, 1.0)
+        assert tuner.choose() == 9
+
+        tuner.record_upload(10 ** 9, 1.0)
+        assert tuner.choose() == 1
+
+
+class TestHashingBuffer:
+
+    def test_hash_matches_contents(self):
+        """Test the running hash matches hashing the finished buffer"""
+        import hashlib
+        from hydrus_node import HashingBuffer
+        buffer = HashingBuffer()
+
+        buffer.write(b"first chunk")
+        buffer.write(b"second chunk")
+
+        assert buffer.hexdigest() == hashlib.sha256(b"first chunksecond chunk").hexdigest()
+
+    def test_hash_after_rewrite(self):
+        """Test seeking back and overwriting still gives the right hash"""
+        import hashlib
+        from hydrus_node import HashingBuffer
+        buffer = HashingBuffer()
+
+        buffer.write(b"xxxx tail")
+        buffer.seek(0)
+        buffer.write(b"head")
+
+        assert buffer.hexdigest() == hashlib.sha256(b"head tail").hexdigest()
+
+    def test_reader_returns_memoryview(self):
+        """Test the reader hands out a view of the buffer instead of a copy"""
+        from hydrus_node import HashingBuffer
+        buffer = HashingBuffer()
+        buffer.write(b"image bytes")
+
+        view = buffer.reader().read()
+
+        assert isinstance(view, memoryview)
+        assert bytes(view) == b"image bytes"
+
+
+class TestHydrusServiceCache:
+
+    def test_service_key_is_cached(self, mock_hydrus_client):
+        """Test repeated service key lookups only ask Hydrus once"""
+        assert get_hydrus_service_key(mock_hydrus_client) == "test_service_key"
+        assert get_hydrus_service_key(mock_hydrus_client) == "test_service_key"
+
+        mock_hydrus_client.get_services.assert_called_once()
+
+    def test_permissions_are_cached(self, mock_hydrus_client):
+        """Test a successful permission check is reused"""
+        from hydrus_node import verify_hydrus_permissions
+        mock_hydrus_client.verify_access_key.return_value = {"basic_permissions": [0, 1, 2, 3]}
+
+        assert verify_hydrus_permissions(mock_hydrus_client)
+        assert verify_hydrus_permissions(mock_hydrus_client)
+
+        mock_hydrus_client.verify_access_key.assert_called_once()
+
+    def test_failed_permissions_not_cached(self, mock_hydrus_client):
+        """Test a failed permission check is asked again next time"""
+        from hydrus_node import verify_hydrus_permissions
+        mock_hydrus_client.verify_access_key.return_value = {"basic_permissions": []}
+
+        assert not verify_hydrus_permissions(mock_hydrus_client)
+        assert not verify_hydrus_permissions(mock_hydrus_client)
+
+        assert mock_hydrus_client.verify_access_key.call_count == 2
+
+    def test_ttl_expiry(self, mock_hydrus_client):
+        """Test entries are refreshed once they are older than the TTL"""
+        from hydrus_node import HydrusServiceCache
+        cache = HydrusServiceCache(ttl=0)
+        loader = Mock(return_value="value")
+
+        cache.get(mock_hydrus_client, "thing", loader)
+        cache.get(mock_hydrus_client, "thing", loader)
+
+        assert loader.call_count == 2
+
+    def test_invalidate_one_client(self, mock_hydrus_client):
+        """Test invalidating a client drops only its entries"""
+        from hydrus_node import HydrusServiceCache
+        cache = HydrusServiceCache(ttl=300)
+        other_client = Mock()
+        loader = Mock(return_value="value")
+
+        cache.get(mock_hydrus_client, "thing", loader)
+        cache.get(other_client, "thing", loader)
+        cache.invalidate(mock_hydrus_client)
+        cache.get(mock_hydrus_client, "thing", loader)
+        cache.get(other_client, "thing", loader)
+
+        assert loader.call_count == 3
+
+
+class TestHydrusSessionPool:
+
+    def test_default_timeout(self):
+        """Test requests get the configured timeout unless one is given"""
+        from hydrus_node import HydrusSessionPool
+        pool = HydrusSessionPool(connect_timeout=2, read_timeout=30)
+
+        with patch('requests.Session.request') as mock_request:
+            pool.request("GET", "http://localhost:45869/api_version")
+            pool.request("GET", "http://localhost:45869/api_version", timeout=1)
+
+        assert mock_request.call_args_list[0].kwargs["timeout"] == (2, 30)
+        assert mock_request.call_args_list[1].kwargs["timeout"] == 1
+
+    def test_threads_share_connection_pool(self):
+        """Test each thread gets its own session but the same adapter"""
+        import threading
+        from hydrus_node import HydrusSessionPool
+        pool = HydrusSessionPool()
+        sessions = []
+
+        thread = threading.Thread(target=lambda: sessions.append(pool.session()))
+        thread.start()
+        thread.join()
+        sessions.append(pool.session())
+
+        assert sessions[0] is not sessions[1]
+        assert sessions[0].get_adapter("http://x") is sessions[1].get_adapter("http://x") is pool.adapter
+        assert pool.session() is sessions[1]
+
+    def test_retry_settings(self):
+        """Test transient failures are retried with backoff"""
+        from hydrus_node import HydrusSessionPool
+        pool = HydrusSessionPool(retries=4, backoff=0.25)
+
+        retry = pool.adapter.max_retries
+        assert retry.total == 4
+        assert retry.backoff_factor == 0.25
+        assert 503 in retry.status_forcelist
+        assert retry.allowed_methods is None
+
+
+class TestParseGenerationTags:
+
+    def test_namespaces(self):
+        """Test every generation namespace is picked up"""
+        from hydrus_node import parse_generation_tags
+
+        result = parse_generation_tags([
+            'modelname:model', 'positive:a cat', 'negative: blurry', 'seed:42', 'lora:one', 'lora:two', 'ai'
+        ])
+
+        assert result == {
+            'modelname': 'model', 'positive': 'a cat', 'negative': 'blurry', 'seed': '42', 'loras': ['one', 'two']
+        }
+
+    def test_namespace_inside_prompt_is_ignored(self):
+        """Test a prompt containing another namespace doesn't get mistaken for it"""
+        from hydrus_node import parse_generation_tags
+
+        result = parse_generation_tags(['positive:portrait, seed:pods, lora:style', 'seed:7'])
+
+        assert result['positive'] == 'portrait, seed:pods, lora:style'
+        assert result['seed'] == '7'
+        assert result['loras'] == []
+
+
+class TestNormalizeTag:
+
+    def test_matches_hydrus(self):
+        """Test tags come out the way Hydrus stores them"""
+        from hydrus_tags import normalize_tag
+
+        assert normalize_tag(' Hyshare: AI ') == 'hyshare:ai'
+        assert normalize_tag('modelname :Model_V2') == 'modelname:model_v2'
+        assert normalize_tag('To Upscale') == 'to upscale'
+
+    def test_only_first_colon(self):
+        """Test colons inside the subtag are left alone"""
+        from hydrus_tags import normalize_tag
+
+        assert normalize_tag('positive: a cat, seed: 3') == 'positive:a cat, seed: 3'
+
+
+class TestHashFile:
+
+    def test_streams_and_matches_sha256(self, tmp_path):
+        """Test the chunked hash matches hashing the whole file at once"""
+        import hashlib
+        from hydrus_node import hash_file
+        path = tmp_path / "image.png"
+        data = os.urandom(10000)
+        path.write_bytes(data)
+
+        assert hash_file(str(path), chunk_size=1000) == hashlib.sha256(data).hexdigest()
+
+    def test_unchanged_file_not_read_again(self, tmp_path):
+        """Test a file with the same size and mtime gets its hash from the cache"""
+        from hydrus_node import hash_file
+        path = tmp_path / "image.png"
+        path.write_bytes(b"original")
+        first = hash_file(str(path))
+
+        with patch('builtins.open', side_effect=AssertionError("file was read again")):
+            assert hash_file(str(path)) == first
+
+    def test_changed_file_is_rehashed(self, tmp_path):
+        """Test changing a file's contents gives a new hash"""
+        import hashlib
+        from hydrus_node import hash_file
+        path = tmp_path / "image.png"
+        path.write_bytes(b"original")
+        hash_file(str(path))
+
+        path.write_bytes(b"different contents")
+        os.utime(path, ns=(1, 1))
+
+        assert hash_file(str(path)) == hashlib.sha256(b"different contents").hexdigest()